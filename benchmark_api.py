@@ -0,0 +1,565 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import types
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+API_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "infrastructure",
+    "src",
+    "lambda",
+    "api",
+)
+DIMENSIONS = 384
+SEED_TABLE = "bench_companies"
+COUNTRIES = ["US", "CA", "DE", "FR", "GB", "JP", "BR", "IN", "AU", "MX"]
+INDUSTRIES = ["software", "finance", "retail", "health", "energy", "media"]
+# Words for the questions which don't match a template and go to the LLM.
+VOCABULARY = (
+    "revenue companies country industry average total likelihood close largest "
+    "smallest growth region employees deals pipeline quarter month year churn "
+    "customers segment share median count trend owner city created"
+).split()
+
+# The tables the API reads and writes, recreated on every run.
+SCHEMA = f"""
+DROP TABLE IF EXISTS queries, user_queries, table_versions, schema_embeddings, {SEED_TABLE} CASCADE;
+CREATE EXTENSION IF NOT EXISTS vector;
+CREATE TABLE {SEED_TABLE} (
+    "Company name" text,
+    "Annual Revenue" double precision,
+    "Country/Region" text,
+    "Likelihood to close" double precision,
+    industry text,
+    employees integer
+);
+CREATE TABLE queries (
+    id bigserial PRIMARY KEY,
+    name text,
+    query text,
+    args text ARRAY,
+    arg_types text ARRAY,
+    embedding vector({DIMENSIONS})
+);
+CREATE TABLE user_queries (
+    id bigserial PRIMARY KEY,
+    user_query text,
+    sql_query text,
+    conversation_history text,
+    embedding vector({DIMENSIONS}),
+    succeeded boolean DEFAULT false,
+    schema_version text,
+    guard_action text,
+    created_at timestamptz DEFAULT now()
+);
+CREATE TABLE table_versions (
+    table_name text PRIMARY KEY,
+    version bigint NOT NULL DEFAULT 0,
+    updated_at timestamptz DEFAULT now()
+);
+CREATE TABLE schema_embeddings (
+    key text PRIMARY KEY,
+    table_schema text,
+    table_name text,
+    column_name text,
+    description text,
+    embedding vector({DIMENSIONS})
+);
+"""
+# Empty tables which only make the schema, and so the LLM's prompt, larger.
+EXTRA_TABLE_PREFIX = "bench_extra_"
+
+# The SQL the fake LLM writes for questions which don't match a template.
+LLM_QUERIES = [
+    f'SELECT "Country/Region", SUM("Annual Revenue") FROM {SEED_TABLE} GROUP BY 1 ORDER BY 2 DESC',
+    f'SELECT industry, AVG("Likelihood to close") FROM {SEED_TABLE} GROUP BY 1',
+    f'SELECT "Company name", employees FROM {SEED_TABLE} ORDER BY employees DESC LIMIT 20',
+    f'SELECT COUNT(*) FROM {SEED_TABLE} WHERE "Likelihood to close" > 0.5',
+]
+
+
+def fake_embedding(text: str) -> List[float]:
+    """A deterministic stand in for gte-small, a normalized bag of hashed words.
+
+    Questions sharing most of their words are close, which is all the template and
+    answer cache lookups need.
+    """
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode()).digest()
+        index = int.from_bytes(digest[:4], "little") % DIMENSIONS
+        vector[index] += 1.0 if digest[4] % 2 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def make_templates(n: int) -> List[Dict[str, Any]]:
+    """Generate n query templates over the seed table, each with its own question."""
+    metrics = [
+        ("total revenue", 'SUM("Annual Revenue")'),
+        ("average revenue", 'AVG("Annual Revenue")'),
+        ("average likelihood to close", 'AVG("Likelihood to close")'),
+        ("number of companies", "COUNT(*)"),
+        ("total employees", "SUM(employees)"),
+    ]
+    groups = [
+        ("country", '"Country/Region"'),
+        ("industry", "industry"),
+    ]
+    templates = []
+    for i in range(n):
+        (metric_name, metric), (group_name, group) = (
+            metrics[i % len(metrics)],
+            groups[(i // len(metrics)) % len(groups)],
+        )
+        templates.append(
+            {
+                "name": f"template_{i}",
+                "question": f"{metric_name} by {group_name} for likely deals variant{i}",
+                "query": (
+                    f"SELECT {group}, {metric} AS value FROM {SEED_TABLE} "
+                    f'WHERE "Likelihood to close" >= {{threshold}} '
+                    f"GROUP BY {group} ORDER BY value {{order}} LIMIT {{limit}}"
+                ),
+                "args": ["threshold", "order", "limit"],
+                "arg_types": ["number", "string", "number"],
+            }
+        )
+    return templates
+
+
+def extra_tables_sql(tables: int, columns: int) -> str:
+    """Create `tables` empty tables of `columns` columns named after the vocabulary."""
+    rng = random.Random(1)
+    statements = []
+    for i in range(tables):
+        rendered = ", ".join(
+            f"{rng.choice(VOCABULARY)}_{j} {rng.choice(['text', 'bigint', 'numeric'])}"
+            for j in range(columns)
+        )
+        statements.append(
+            f"CREATE TABLE {EXTRA_TABLE_PREFIX}{i} (id bigserial PRIMARY KEY, {rendered});"
+        )
+    return "\n".join(statements)
+
+
+async def setup_database(
+    pool,
+    templates: List[Dict[str, Any]],
+    seed_rows: int,
+    extra_tables: int = 0,
+    extra_columns: int = 20,
+):
+    """Recreate the API's tables with synthetic data and build the ANN indexes."""
+    rng = random.Random(0)
+    async with pool.acquire() as conn:
+        await conn.execute(SCHEMA)
+        for name in await conn.fetch(
+            "SELECT tablename FROM pg_tables WHERE tablename LIKE $1",
+            EXTRA_TABLE_PREFIX + "%",
+        ):
+            await conn.execute(f"DROP TABLE {name[0]}")
+        if extra_tables:
+            await conn.execute(extra_tables_sql(extra_tables, extra_columns))
+        await conn.copy_records_to_table(
+            SEED_TABLE,
+            records=[
+                (
+                    f"company{i}",
+                    rng.lognormvariate(13, 1.5),
+                    rng.choice(COUNTRIES),
+                    rng.random(),
+                    rng.choice(INDUSTRIES),
+                    rng.randint(1, 5000),
+                )
+                for i in range(seed_rows)
+            ],
+        )
+        # The codecs are registered per connection, so send the vectors as text.
+        await conn.executemany(
+            "INSERT INTO queries (name, query, args, arg_types, embedding) "
+            "VALUES ($1, $2, $3, $4, $5::text::vector)",
+            [
+                (
+                    t["name"],
+                    t["query"],
+                    t["args"],
+                    t["arg_types"],
+                    str(fake_embedding(t["question"])),
+                )
+                for t in templates
+            ],
+        )
+        for table in ("queries", "user_queries"):
+            await conn.execute(
+                f"CREATE INDEX ON {table} USING hnsw (embedding vector_cosine_ops)"
+            )
+        await conn.execute("ANALYZE")
+
+
+class FakeOpenAI:
+    """Stands in for AsyncOpenAI with a fixed latency per call.
+
+    The tool call picks the most similar template, or answers without one for
+    `no_tool_rate` of the questions. The SQL generation returns broken SQL for
+    `bad_sql_rate` of the first attempts so the retry path gets exercised.
+    """
+
+    def __init__(
+        self,
+        tool_latency: float,
+        sql_latency: float,
+        jitter: float,
+        no_tool_rate: float,
+        bad_sql_rate: float,
+        rng: random.Random,
+        prompt_latency: float = 0.0,
+    ):
+        self.tool_latency = tool_latency
+        self.sql_latency = sql_latency
+        self.prompt_latency = prompt_latency
+        self.jitter = jitter
+        self.no_tool_rate = no_tool_rate
+        self.bad_sql_rate = bad_sql_rate
+        self.rng = rng
+        self.chat = types.SimpleNamespace(
+            completions=types.SimpleNamespace(create=self.create)
+        )
+        self.beta = types.SimpleNamespace(
+            chat=types.SimpleNamespace(
+                completions=types.SimpleNamespace(parse=self.parse)
+            )
+        )
+
+    async def _sleep(self, seconds: float):
+        await asyncio.sleep(
+            seconds * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        )
+
+    async def create(self, model, messages, tools):
+        await self._sleep(self.tool_latency)
+        if self.rng.random() < self.no_tool_rate:
+            message = types.SimpleNamespace(tool_calls=None)
+            return types.SimpleNamespace(
+                choices=[types.SimpleNamespace(finish_reason="stop", message=message)]
+            )
+        function = tools[0]["function"]
+        values = {"number": 0.5, "integer": 10, "boolean": True, "string": "DESC"}
+        arguments = {
+            name: values.get(spec["type"], "DESC")
+            for name, spec in function["parameters"]["properties"].items()
+        }
+        if "limit" in arguments:
+            arguments["limit"] = 10
+        call = types.SimpleNamespace(
+            function=types.SimpleNamespace(
+                name=function["name"], arguments=json.dumps(arguments)
+            )
+        )
+        message = types.SimpleNamespace(tool_calls=[call])
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(finish_reason="tool_calls", message=message)]
+        )
+
+    async def parse(self, model, messages, response_format):
+        # Roughly 4 characters per token, the longer the prompt the longer the call.
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        await self._sleep(self.sql_latency + prompt_tokens / 1000 * self.prompt_latency)
+        retry = len(messages) > 2
+        if not retry and self.rng.random() < self.bad_sql_rate:
+            sql = f"SELEC * FROM {SEED_TABLE}"
+        else:
+            sql = self.rng.choice(LLM_QUERIES)
+        content = json.dumps({"sql_query": sql, "notes": ""})
+        message = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=message)],
+            usage=types.SimpleNamespace(prompt_tokens=prompt_tokens),
+        )
+
+
+def install_fakes(args, rng: random.Random):
+    """Replace the sagemaker endpoint and the OpenAI client with the stand ins."""
+    import clients
+    import embeddings
+
+    def sleep(seconds: float):
+        time.sleep(seconds * rng.uniform(1 - args.jitter, 1 + args.jitter))
+
+    def invoke_embedding_endpoint(text: str) -> List[float]:
+        sleep(args.embedding_latency_ms / 1000)
+        return fake_embedding(text)
+
+    def invoke_embedding_endpoint_batch(texts: List[str]) -> List[List[float]]:
+        sleep(args.embedding_latency_ms / 1000)
+        return [fake_embedding(t) for t in texts]
+
+    embeddings.invoke_embedding_endpoint = invoke_embedding_endpoint
+    embeddings.invoke_embedding_endpoint_batch = invoke_embedding_endpoint_batch
+    clients._CLIENTS["openai"] = FakeOpenAI(
+        args.tool_latency_ms / 1000,
+        args.sql_latency_ms / 1000,
+        args.jitter,
+        args.no_tool_rate,
+        args.bad_sql_rate,
+        rng,
+        args.prompt_latency_ms / 1000,
+    )
+
+
+def make_requests(
+    n: int, templates: List[Dict[str, Any]], args, rng: random.Random
+) -> List[Dict[str, Any]]:
+    """Build the workload. Every question gets a unique word so it misses the
+    embedding cache but stays close to its template."""
+    requests = []
+    for i in range(n):
+        if rng.random() < args.template_rate:
+            question = f"{rng.choice(templates)['question']} q{i}"
+        else:
+            question = " ".join(rng.sample(VOCABULARY, 6)) + f" q{i}"
+        if rng.random() < args.find_rate:
+            requests.append(
+                {"method": "GET", "url": "/find", "params": {"query": question}}
+            )
+        else:
+            body = {"query": question, "use_answer_cache": args.answer_cache}
+            requests.append({"method": "POST", "url": "/query", "json": body})
+    return requests
+
+
+def percentiles(samples: List[float], unit: str = "ms") -> Dict[str, float]:
+    """Summarize latencies in milliseconds, or other numbers in `unit`."""
+    if not samples:
+        return {}
+    values = np.array(samples)
+    suffix = f"_{unit}" if unit else ""
+    return {
+        "count": len(samples),
+        f"mean{suffix}": round(float(values.mean()), 2),
+        f"p50{suffix}": round(float(np.percentile(values, 50)), 2),
+        f"p95{suffix}": round(float(np.percentile(values, 95)), 2),
+        f"p99{suffix}": round(float(np.percentile(values, 99)), 2),
+    }
+
+
+def summarize(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Latency percentiles per endpoint, per stage and per path.
+
+    Numbers recorded with the requests, e.g. prompt tokens, are summarized too.
+    """
+    out = {}
+    by_endpoint = defaultdict(list)
+    for record in records:
+        by_endpoint[record["endpoint"]].append(record)
+    for endpoint, rows in sorted(by_endpoint.items()):
+        stages = defaultdict(list)
+        paths = defaultdict(list)
+        values = defaultdict(list)
+        for row in rows:
+            paths[row["path"]].append(row["total_ms"])
+            for stage, ms in row["stages_ms"].items():
+                stages[stage].append(ms)
+            for name, value in row.get("values", {}).items():
+                values[name].append(value)
+        out[endpoint] = {
+            "total": percentiles([r["total_ms"] for r in rows]),
+            "errors": sum(r["status"] != "ok" for r in rows),
+            "paths": {p: percentiles(v) for p, v in sorted(paths.items())},
+            "stages": {s: percentiles(v) for s, v in stages.items()},
+            "values": {n: percentiles(v, unit="") for n, v in values.items()},
+            "events": dict(Counter(e for r in rows for e in r["events"])),
+        }
+    return out
+
+
+async def run_level(app, requests: List[Dict[str, Any]], concurrency: int):
+    """Send the requests with at most `concurrency` in flight."""
+    import httpx
+    from metrics import REQUEST_LISTENERS
+
+    records: List[Dict[str, Any]] = []
+    REQUEST_LISTENERS.append(records.append)
+    queue: asyncio.Queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    statuses = Counter()
+
+    async def worker(client):
+        while not queue.empty():
+            request = queue.get_nowait()
+            response = await client.request(**request)
+            statuses[response.status_code] += 1
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    start = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", timeout=None
+        ) as client:
+            await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+    finally:
+        REQUEST_LISTENERS.remove(records.append)
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(requests) / seconds, 2),
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "endpoints": summarize(records),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> Dict[str, Any]:
+    # The API reads its configuration when it's imported.
+    sys.path.insert(0, API_DIR)
+    import main as api
+    from db import get_async_pool
+    from query_log import QUERY_LOGGER
+
+    rng = random.Random(args.seed)
+    templates = make_templates(args.templates)
+    pool = await get_async_pool()
+    print(f"Loading {args.seed_rows} rows and {args.templates} templates")
+    await setup_database(
+        pool, templates, args.seed_rows, args.extra_tables, args.extra_columns
+    )
+    # Reconnect so every connection registers the vector codecs, the extension may
+    # have been created above.
+    await pool.expire_connections()
+    install_fakes(args, rng)
+
+    levels = []
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        print(f"Running {args.requests} requests at concurrency {concurrency}")
+        # The API prints a lot per request, only keep it when asked.
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            warmup = make_requests(args.warmup, templates, args, rng)
+            await run_level(api.app, warmup, concurrency)
+            result = await run_level(
+                api.app,
+                make_requests(args.requests, templates, args, rng),
+                concurrency,
+            )
+            await QUERY_LOGGER.flush()
+        print(json.dumps(result, indent=2))
+        levels.append(result)
+    return {
+        "commit": git_commit(),
+        "config": vars(args),
+        "templates": len(templates),
+        "levels": levels,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API against a local postgres with fake SageMaker "
+        "and OpenAI backends. Recreates the queries and user_queries tables!"
+    )
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", default="5432")
+    parser.add_argument("--db-password", default="postgres")
+    parser.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="Allow a database which isn't on this machine, its tables are dropped",
+    )
+    parser.add_argument("--seed-rows", type=int, default=10000)
+    parser.add_argument("--templates", type=int, default=50)
+    parser.add_argument(
+        "--requests", type=int, default=500, help="Requests per concurrency level"
+    )
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument(
+        "--concurrency", default="1,8,32", help="Comma separated concurrency levels"
+    )
+    parser.add_argument(
+        "--find-rate", type=float, default=0.2, help="Share of requests to /find"
+    )
+    parser.add_argument(
+        "--template-rate",
+        type=float,
+        default=0.7,
+        help="Share of questions close to a template, the rest go to the LLM",
+    )
+    parser.add_argument("--no-tool-rate", type=float, default=0.05)
+    parser.add_argument("--bad-sql-rate", type=float, default=0.1)
+    parser.add_argument("--answer-cache", action="store_true")
+    parser.add_argument("--embedding-latency-ms", type=float, default=30)
+    parser.add_argument("--tool-latency-ms", type=float, default=600)
+    parser.add_argument("--sql-latency-ms", type=float, default=1500)
+    parser.add_argument(
+        "--prompt-latency-ms",
+        type=float,
+        default=25,
+        help="Extra SQL generation latency per 1000 prompt tokens",
+    )
+    parser.add_argument(
+        "--extra-tables",
+        type=int,
+        default=0,
+        help="Add this many empty tables to grow the schema sent to the LLM",
+    )
+    parser.add_argument("--extra-columns", type=int, default=20)
+    parser.add_argument(
+        "--schema-retrieval",
+        action="store_true",
+        help="Only send the LLM the tables and columns closest to the question",
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.2, help="Latencies vary by +/- this fraction"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the API's output")
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    local = args.db_host in (
+        "localhost",
+        "127.0.0.1",
+        "::1",
+    ) or args.db_host.startswith("/")
+    if not local and not args.allow_remote:
+        parser.error(f"{args.db_host} isn't local, pass --allow-remote to use it")
+    os.environ.update(
+        {
+            "DB_HOST": args.db_host,
+            "DB_PORT": str(args.db_port),
+            "DB_PASSWORD": args.db_password,
+            "OPENAI_API_KEY": "benchmark",
+            "EMBEDDING_BACKEND": "sagemaker",
+            "METRICS_LOG": "false",
+            "SCHEMA_RETRIEVAL_ENABLED": str(args.schema_retrieval).lower(),
+        }
+    )
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
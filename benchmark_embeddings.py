@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "infrastructure",
+        "src",
+        "lambda",
+        "api",
+    ),
+)
+from embeddings import EMBEDDING_BACKENDS  # noqa: E402
+
+SAMPLE_TEXTS = [
+    "What is the total revenue by country?",
+    "Which countries bring in the most revenue?",
+    "Show me the top 10 companies by annual revenue",
+    "List the five largest companies by revenue",
+    "What is the average annual revenue of companies likely to close?",
+    "Average revenue for institutions with a high chance of closing",
+    "What is the average likelihood to close by industry?",
+    "Which industries are most likely to close a deal?",
+    "How many companies are there in each country?",
+    "Which companies have more than 500 employees?",
+    "What is the median number of employees per industry?",
+    "Show companies created in the last 30 days",
+    "Which sales rep owns the most companies?",
+    "What is the total revenue of software companies in Germany?",
+    "List companies with no phone number",
+    "What share of revenue comes from the top 1% of companies?",
+    "Count the companies per lifecycle stage",
+    "Which city has the most companies?",
+    "Show the smallest companies by revenue",
+    "What is the revenue distribution by company size?",
+]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Summarize latencies in milliseconds."""
+    ms = np.array(samples) * 1000
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def benchmark_backend(backend, texts: List[str], repeats: int, batch_size: int):
+    """Time loading, single text and batched encoding on one backend."""
+    start = time.perf_counter()
+    if hasattr(backend, "load"):
+        backend.load()
+    backend.embed(texts[:1])
+    load_seconds = time.perf_counter() - start
+
+    single = []
+    for _ in range(repeats):
+        for text in texts:
+            start = time.perf_counter()
+            backend.embed_one(text)
+            single.append(time.perf_counter() - start)
+
+    batched = []
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        start = time.perf_counter()
+        embeddings.extend(backend.embed(texts[i : i + batch_size]))
+        batched.append(time.perf_counter() - start)
+    return {
+        "first_call_ms": load_seconds * 1000,
+        "single": percentiles(single),
+        "batch": {**percentiles(batched), "batch_size": batch_size},
+        "texts_per_second": len(texts) / sum(batched),
+    }, np.array(embeddings, dtype=np.float32)
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def parity(reference: np.ndarray, candidate: np.ndarray, k: int) -> Dict[str, float]:
+    """Compare two backends' embeddings of the same texts.
+
+    Recall is the overlap of each text's k nearest neighbours (excluding itself)
+    under the two backends, i.e. whether retrieval would return the same templates.
+    """
+    reference, candidate = normalize(reference), normalize(candidate)
+    cosine = (reference * candidate).sum(axis=1)
+    k = min(k, len(reference) - 1)
+    recalls = []
+    for scores_a, scores_b, i in zip(
+        reference @ reference.T, candidate @ candidate.T, range(len(reference))
+    ):
+        scores_a[i] = scores_b[i] = -np.inf
+        top_a = set(np.argsort(-scores_a)[:k])
+        top_b = set(np.argsort(-scores_b)[:k])
+        recalls.append(len(top_a & top_b) / k)
+    return {
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        f"recall_at_{k}": float(statistics.mean(recalls)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the latency and retrieval parity of the embedding backends"
+    )
+    parser.add_argument(
+        "--backends",
+        default="sagemaker,local",
+        help="Comma separated backends, the first is the parity reference",
+    )
+    parser.add_argument(
+        "--texts-file",
+        default=None,
+        help="A file with one text per line, defaults to built in sample questions",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    if args.texts_file:
+        with open(args.texts_file) as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = SAMPLE_TEXTS
+
+    results, vectors = {}, {}
+    for name in args.backends.split(","):
+        print(f"Benchmarking {name} on {len(texts)} texts")
+        results[name], vectors[name] = benchmark_backend(
+            EMBEDDING_BACKENDS[name](), texts, args.repeats, args.batch_size
+        )
+        print(json.dumps(results[name], indent=2))
+
+    reference = args.backends.split(",")[0]
+    for name in vectors:
+        if name != reference:
+            results[name]["parity"] = parity(vectors[reference], vectors[name], args.k)
+            print(f"{name} vs {reference}: {results[name]['parity']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"texts": len(texts), "backends": results}, f, indent=2)
@@ -37,6 +37,16 @@ class APILambdaStack(Stack):
             retention=logs.RetentionDays.ONE_WEEK,
         )
 
+        # The key page tokens are signed with, shared by every container of the API.
+        page_token_secret = secretsmanager.Secret(
+            self,
+            "PageTokenSecret",
+            generate_secret_string=secretsmanager.SecretStringGenerator(
+                exclude_punctuation=True,
+                password_length=64,
+            ),
+        )
+
         # Define the Lambda function with a very simple Hello World response inline
         self.api_fn = _lambda.DockerImageFunction(
             self,
@@ -55,6 +65,7 @@ class APILambdaStack(Stack):
                 "DB_PASSWORD": "...",  # TODO: GET THIS AUTOMATICALLY
                 "DB_PORT": "5432",
                 "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
+                "PAGE_TOKEN_SECRET": page_token_secret.secret_value.unsafe_unwrap(),
             },
             vpc=vpc,
             security_groups=[lambda_sg],
@@ -0,0 +1,127 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+
+# Reuse the SQL of a previous question when its embedding is within this cosine distance.
+# gte-small puts most questions about the same tables within 0.05 of each other, so keep
+# this tight. The literals of the questions have to match as well.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.02"))
+# The number of nearest past questions checked for matching literals.
+ANSWER_CACHE_CANDIDATES = int(os.getenv("ANSWER_CACHE_CANDIDATES", "5"))
+# Answers older than this are never reused.
+ANSWER_CACHE_MAX_AGE_SECONDS = float(
+    os.getenv("ANSWER_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 60 * 60))
+)
+# Only reuse answers generated against the current schema version.
+ANSWER_CACHE_MATCH_SCHEMA = (
+    os.getenv("ANSWER_CACHE_MATCH_SCHEMA", "true").lower() == "true"
+)
+
+LOOKUP_QUERY = """
+SELECT id, user_query, sql_query, (embedding <=> $1) AS distance
+FROM user_queries
+WHERE succeeded
+    AND created_at > now() - make_interval(secs => $2)
+    AND ($3::text IS NULL OR schema_version = $3)
+ORDER BY distance
+LIMIT $4
+"""
+
+# Numbers and quoted strings, "top 10 companies" and "top 20 companies" embed almost the
+# same but need different SQL.
+_LITERALS = re.compile(r"'[^']*'|\"[^\"]*\"|\d+(?:[.,]\d+)*")
+
+
+def question_literals(question: str) -> List[str]:
+    """Get the literals of a question, in a canonical order for comparing."""
+    return sorted(m.lower() for m in _LITERALS.findall(question))
+
+
+class AnswerCache:
+    """Find previously answered questions that are close enough to reuse their SQL.
+
+    Every successful LLM generated query is logged to `user_queries` with the embedding
+    of the question that produced it. A new question within `max_distance` of one of
+    those, with the same numbers and quoted strings, reuses the stored SQL and skips the
+    LLM entirely.
+
+    :param enabled: Turn the cache off without removing it from the pipeline.
+    :param max_distance: The largest cosine distance that counts as the same question.
+    :param max_age_seconds: Ignore answers older than this.
+    :param match_schema: Ignore answers generated against an older schema version.
+    :param candidates: The number of nearest questions checked for matching literals.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = ANSWER_CACHE_ENABLED,
+        max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+        max_age_seconds: float = ANSWER_CACHE_MAX_AGE_SECONDS,
+        match_schema: bool = ANSWER_CACHE_MATCH_SCHEMA,
+        candidates: int = ANSWER_CACHE_CANDIDATES,
+    ):
+        self.enabled = enabled
+        self.max_distance = max_distance
+        self.max_age_seconds = max_age_seconds
+        self.match_schema = match_schema
+        self.candidates = candidates
+        self.counters = {"hits": 0, "misses": 0, "failed_reuse": 0}
+
+    async def lookup(
+        self,
+        conn: asyncpg.Connection,
+        question: str,
+        embedding: List[float],
+        schema_version: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Get the closest previously answered question if it is close enough.
+
+        :param conn: An asyncpg connection or pool.
+        :param question: The new question.
+        :param embedding: The embedding of the new question.
+        :param schema_version: The current schema version.
+        :return: The id, question, SQL, and distance of the match or None.
+        """
+        if not self.enabled:
+            return None
+        try:
+            rows = await conn.fetch(
+                LOOKUP_QUERY,
+                embedding,
+                self.max_age_seconds,
+                schema_version if self.match_schema else None,
+                self.candidates,
+            )
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+            print("user_queries is missing the answer cache columns, run setup_db.py.")
+            self.enabled = False
+            return None
+        literals = question_literals(question)
+        for row in rows:
+            if row["distance"] > self.max_distance:
+                break
+            if question_literals(row["user_query"]) == literals:
+                self.counters["hits"] += 1
+                return dict(row)
+        self.counters["misses"] += 1
+        return None
+
+    def record_failed_reuse(self):
+        """Count a cached SQL query that no longer runs, e.g. after a data change."""
+        self.counters["failed_reuse"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+            "enabled": self.enabled,
+            "max_distance": self.max_distance,
+            "max_age_seconds": self.max_age_seconds,
+        }
+
+
+ANSWER_CACHE = AnswerCache()
@@ -0,0 +1,49 @@
+import os
+import threading
+from typing import Any, Dict, List
+
+# The SDKs are imported on first use. openai alone takes ~0.7s to import and boto3
+# ~0.2s which is paid on every cold start whether or not the request needs them.
+_CLIENTS: Dict[str, Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_or_create(key: str, create):
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = create()
+    return client
+
+
+def get_openai_client():
+    """Get the module level AsyncOpenAI client, created on first use."""
+
+    def create():
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+    return _get_or_create("openai", create)
+
+
+def get_boto3_client(service: str):
+    """Get the module level boto3 client for a service, created on first use.
+
+    boto3 clients are thread safe and building one loads the service model from disk
+    so every caller shares one client per service.
+    """
+
+    def create():
+        import boto3
+
+        return boto3.client(service)
+
+    return _get_or_create(f"boto3:{service}", create)
+
+
+def loaded_clients() -> List[str]:
+    """The clients created so far, reported by /stats."""
+    return sorted(_CLIENTS)
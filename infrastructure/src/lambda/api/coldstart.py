@@ -0,0 +1,68 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+# Imported first by main so the import phases are measured from here.
+_START = time.perf_counter()
+
+# Comma separated work done during lambda init instead of on the first request, any of
+# "pool", "schema", "templates", "embedding" and "openai", or "all". Init runs before the first
+# request is accepted so this trades a slower init for a faster first response, and
+# it's what provisioned concurrency keeps warm.
+PREWARM = os.getenv("PREWARM", "")
+PREWARM_STEPS = ("pool", "schema", "templates", "embedding", "openai")
+
+
+def prewarm_steps(value: str = PREWARM) -> List[str]:
+    """Parse PREWARM into the steps to run, in the order they should run."""
+    requested = {s.strip().lower() for s in value.split(",") if s.strip()}
+    if "all" in requested:
+        return list(PREWARM_STEPS)
+    unknown = requested - set(PREWARM_STEPS)
+    if unknown:
+        print(f"Ignoring unknown PREWARM steps {', '.join(sorted(unknown))}")
+    return [s for s in PREWARM_STEPS if s in requested]
+
+
+class ColdStartProfile:
+    """Records how long each phase of starting the container took.
+
+    `mark` closes the phase running since the previous mark. The report is printed as
+    one JSON line at the end of init so cold starts can be tracked per release in the
+    logs, and is also served by /stats. The first request is timed separately because
+    everything deferred to first use lands on it.
+    """
+
+    def __init__(self, start: float = _START):
+        self.start = start
+        self._last = start
+        self.phases: Dict[str, float] = {}
+        self.first_request_ms: Optional[float] = None
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = (now - self._last) * 1000
+        self._last = now
+
+    def record_first_request(self, seconds: float):
+        if self.first_request_ms is None:
+            self.first_request_ms = seconds * 1000
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "version": os.getenv("AWS_LAMBDA_FUNCTION_VERSION", "local"),
+            "phases_ms": {k: round(v, 2) for k, v in self.phases.items()},
+            "init_ms": round(sum(self.phases.values()), 2),
+            "first_request_ms": (
+                None
+                if self.first_request_ms is None
+                else round(self.first_request_ms, 2)
+            ),
+        }
+
+    def log(self):
+        print(json.dumps({"cold_start": self.report()}))
+
+
+COLD_START = ColdStartProfile()
@@ -0,0 +1,172 @@
+import json
+import os
+import re
+from typing import Any, Dict, Optional
+
+import asyncpg
+
+from result_cache import normalize_sql
+
+# EXPLAIN generated SQL before running it and stop anything the planner expects to be
+# too expensive, one cross join can keep the RDS micro instance busy for everybody.
+COST_GUARD_ENABLED = os.getenv("COST_GUARD_ENABLED", "true").lower() == "true"
+# Budgets for the planner's estimates. The cost is in postgres' own units, reading one
+# page sequentially costs 1.
+COST_GUARD_MAX_COST = float(os.getenv("COST_GUARD_MAX_COST", "100000"))
+COST_GUARD_MAX_ROWS = int(os.getenv("COST_GUARD_MAX_ROWS", "10000"))
+# What to do with a query over budget. "limit" wraps it in a LIMIT of
+# COST_GUARD_MAX_ROWS and only rejects it if that's still too expensive, "reject" always
+# rejects it.
+COST_GUARD_ACTION = os.getenv("COST_GUARD_ACTION", "limit")
+# The statement_timeout of generated SQL in milliseconds, 0 for none.
+COST_GUARD_STATEMENT_TIMEOUT_MS = int(
+    os.getenv("COST_GUARD_STATEMENT_TIMEOUT_MS", "5000")
+)
+
+# Only queries can be put in a subquery to limit them.
+_LIMITABLE = re.compile(r"^\s*(select|with|values|table)\b", re.IGNORECASE)
+
+
+class QueryRejected(Exception):
+    """Raised for generated SQL the planner expects to be over budget."""
+
+
+class GuardDecision:
+    """What the cost guard did with a SQL query.
+
+    :param sql: The SQL to run, with a LIMIT added if the query was limited.
+    :param action: "ok", "limited", "rejected" or "disabled".
+    :param cost: The planner's total cost estimate of the original query.
+    :param rows: The planner's row estimate of the original query.
+    :param reason: Why the query was limited or rejected.
+    :param error: The error of EXPLAIN when the query couldn't be planned.
+    """
+
+    def __init__(
+        self,
+        sql: str,
+        action: str,
+        cost: Optional[float] = None,
+        rows: Optional[float] = None,
+        reason: str = "",
+        error: Optional[str] = None,
+    ):
+        self.sql = sql
+        self.action = action
+        self.cost = cost
+        self.rows = rows
+        self.reason = reason
+        self.error = error
+
+
+def limit_sql(sql: str, limit: int) -> str:
+    """Wrap a query in a subquery with a LIMIT, comments and a trailing ; are dropped."""
+    return f"SELECT * FROM ({normalize_sql(sql)}) AS guarded LIMIT {int(limit)}"
+
+
+class CostGuard:
+    """Checks the planner's estimates of generated SQL against a budget.
+
+    The estimates come from `EXPLAIN (FORMAT JSON)`, which plans the query without
+    running it. They are only estimates, the statement timeout set by the caller is
+    what stops a query the planner got wrong. A query EXPLAIN fails on is rejected.
+
+    :param enabled: Check queries at all.
+    :param max_cost: The highest total cost estimate allowed.
+    :param max_rows: The most rows a query is expected to return.
+    :param action: "limit" or "reject" queries over budget.
+    :param statement_timeout_ms: The statement_timeout of generated SQL, 0 for none.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = COST_GUARD_ENABLED,
+        max_cost: float = COST_GUARD_MAX_COST,
+        max_rows: int = COST_GUARD_MAX_ROWS,
+        action: str = COST_GUARD_ACTION,
+        statement_timeout_ms: int = COST_GUARD_STATEMENT_TIMEOUT_MS,
+    ):
+        if action not in ("limit", "reject"):
+            raise ValueError(f"Unknown cost guard action {action}")
+        self.enabled = enabled
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.action = action
+        self.statement_timeout_ms = statement_timeout_ms
+        self.counters = {
+            "ok": 0,
+            "limited": 0,
+            "rejected": 0,
+            "disabled": 0,
+        }
+
+    async def explain(self, conn: asyncpg.Connection, sql: str) -> Dict[str, Any]:
+        """Get the top node of the query plan."""
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}")
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
+    async def check(self, pool: asyncpg.Pool, sql: str) -> GuardDecision:
+        """Decide whether to run, limit or reject a query.
+
+        :param pool: The asyncpg pool, or a connection.
+        :param sql: The generated SQL.
+        """
+        decision = await self._check(pool, sql)
+        self.counters[decision.action] += 1
+        if decision.action in ("limited", "rejected"):
+            print(f"Cost guard {decision.action} query: {decision.reason}")
+        return decision
+
+    async def _check(self, pool: asyncpg.Pool, sql: str) -> GuardDecision:
+        if not self.enabled:
+            return GuardDecision(sql, "disabled")
+        async with pool.acquire() as conn:
+            try:
+                plan = await self.explain(conn, sql)
+            except asyncpg.PostgresError as e:
+                # Whatever EXPLAIN can't plan can't be checked either, e.g. DROP or
+                # VACUUM, so it's never run. Broken SQL gets its error to be fixed.
+                return GuardDecision(
+                    sql, "rejected", reason=f"EXPLAIN failed, {e}", error=str(e)
+                )
+            cost, rows = plan["Total Cost"], plan["Plan Rows"]
+            over = []
+            if cost > self.max_cost:
+                over.append(f"estimated cost {cost:g} is over {self.max_cost:g}")
+            if rows > self.max_rows:
+                over.append(f"estimated rows {rows:g} are over {self.max_rows}")
+            if not over:
+                return GuardDecision(sql, "ok", cost, rows)
+            reason = " and ".join(over)
+            if self.action == "reject" or not _LIMITABLE.match(sql):
+                return GuardDecision(sql, "rejected", cost, rows, reason)
+
+            # A LIMIT lets the planner stop early, unless it has to read everything
+            # first, e.g. to sort or aggregate, which the new cost estimate shows.
+            limited = limit_sql(sql, self.max_rows)
+            try:
+                limited_cost = (await self.explain(conn, limited))["Total Cost"]
+            except asyncpg.PostgresError as e:
+                return GuardDecision(sql, "rejected", cost, rows, f"{reason}, {e}")
+        if limited_cost > self.max_cost:
+            reason = (
+                f"{reason}, even with a LIMIT the estimated cost is {limited_cost:g}"
+            )
+            return GuardDecision(sql, "rejected", cost, rows, reason)
+        reason = f"{reason}, limited to {self.max_rows} rows"
+        return GuardDecision(limited, "limited", cost, rows, reason)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "enabled": self.enabled,
+            "max_cost": self.max_cost,
+            "max_rows": self.max_rows,
+            "action": self.action,
+            "statement_timeout_ms": self.statement_timeout_ms,
+        }
+
+
+COST_GUARD = CostGuard()
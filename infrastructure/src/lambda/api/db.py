@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import asyncpg
+
+CREDENTIALS = {
+    "password": os.getenv("DB_PASSWORD", "Tvzh*f]uvxX?`y(L$u`Vyra&b6P9VQQ4"),
+    "host": os.getenv(
+        "DB_HOST",
+        "mainstackrdsstackb4b88b4d-postgresvectordb82399e33-adgdgkmbo427.cbas6w2cunpd.us-west-2.rds.amazonaws.com",
+    ),
+    "port": os.getenv("DB_PORT", "1053"),
+}
+
+# Pool settings. The RDS micro instance only allows a handful of connections so keep
+# the per process maximum small. Every warm lambda container holds its own pool.
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "4"))
+POOL_MAX_IDLE_SECONDS = float(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300"))
+CONNECT_TIMEOUT_SECONDS = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+# Each async connection keeps this many prepared statements, evicting the least recently
+# used. Query templates are bound with $n parameters so every template is parsed and
+# planned once per connection instead of on every call.
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+async def _init_async_connection(conn: asyncpg.Connection):
+    """Register the pgvector codecs once per pooled asyncpg connection."""
+    # pgvector pulls in numpy, import it with the first connection rather than the module.
+    from pgvector.asyncpg import register_vector as register_vector_async
+
+    try:
+        await register_vector_async(conn)
+    except ValueError:
+        # The vector extension hasn't been created yet (fresh database).
+        pass
+
+
+# The statement_timeout in milliseconds of connections acquired inside
+# `statement_timeout`. The pool resets every setting when a connection is released.
+_STATEMENT_TIMEOUT_MS: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "statement_timeout_ms", default=None
+)
+
+
+@contextmanager
+def statement_timeout(milliseconds: Optional[int]) -> Iterator[None]:
+    """Set statement_timeout on the async connections acquired in this block.
+
+    :param milliseconds: The timeout, 0 or None leaves the server default.
+    """
+    token = _STATEMENT_TIMEOUT_MS.set(milliseconds or None)
+    try:
+        yield
+    finally:
+        _STATEMENT_TIMEOUT_MS.reset(token)
+
+
+async def _setup_async_connection(conn):
+    """Apply the settings of the current request each time a connection is acquired."""
+    milliseconds = _STATEMENT_TIMEOUT_MS.get()
+    if milliseconds is not None:
+        await conn.execute(f"SET statement_timeout = {int(milliseconds)}")
+
+
+_ASYNC_POOL: Optional["asyncio.Future[asyncpg.Pool]"] = None
+_ASYNC_POOL_KEY: Optional[Tuple[int, int]] = None
+
+
+async def get_async_pool() -> asyncpg.Pool:
+    """Get the asyncpg pool used by the async request path, creating it on first use.
+
+    The pool is bound to the event loop that created it. Mangum reuses one loop for
+    every warm invocation so the pool survives between requests, it is only recreated
+    in a new process or on a new loop.
+    """
+    global _ASYNC_POOL, _ASYNC_POOL_KEY
+    key = (os.getpid(), id(asyncio.get_running_loop()))
+    if _ASYNC_POOL is None or _ASYNC_POOL_KEY != key:
+        _ASYNC_POOL_KEY = key
+        _ASYNC_POOL = asyncio.ensure_future(
+            asyncpg.create_pool(
+                host=CREDENTIALS["host"],
+                port=CREDENTIALS["port"],
+                database="postgres",
+                user="postgres",  # use the dbuser with iam auth!
+                password=CREDENTIALS["password"],
+                min_size=0,
+                max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_MAX_IDLE_SECONDS,
+                statement_cache_size=STATEMENT_CACHE_SIZE,
+                timeout=CONNECT_TIMEOUT_SECONDS,
+                init=_init_async_connection,
+                setup=_setup_async_connection,
+                server_settings={"application_name": "sql-rag-api"},
+            )
+        )
+    pool_future = _ASYNC_POOL
+    try:
+        return await asyncio.shield(pool_future)
+    except Exception:
+        # Don't cache a failed pool, the next request will try again.
+        if _ASYNC_POOL is pool_future:
+            _ASYNC_POOL, _ASYNC_POOL_KEY = None, None
+        raise
+
+
+def vector_to_list(value) -> List[float]:
+    """Convert a decoded pgvector value (Vector or numpy array) to a list of floats."""
+    if hasattr(value, "to_list"):
+        value = value.to_list()
+    return [float(x) for x in value]
+
+
+def to_row(record) -> tuple:
+    """Convert an asyncpg record to a JSON friendly tuple, decoding vectors to lists."""
+    return tuple(vector_to_list(v) if hasattr(v, "to_list") else v for v in record)
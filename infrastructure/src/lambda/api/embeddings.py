@@ -0,0 +1,457 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+
+from clients import get_boto3_client
+from db import get_async_pool, vector_to_list
+
+EMBEDDING_ENDPOINT = os.getenv("EMBEDDING_ENDPOINT", "query-embedding")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "thenlper/gte-small")
+# Where embeddings are computed, "sagemaker" or "local" for the int8 ONNX export of the
+# model running in process (see models/export_onnx.py).
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sagemaker")
+# The weights the backend runs, the endpoint serves the fp32 model. Backends and
+# quantizations give slightly different vectors so both are part of the cache key.
+EMBEDDING_QUANTIZATION = os.getenv(
+    "EMBEDDING_QUANTIZATION", "int8" if EMBEDDING_BACKEND == "local" else "fp32"
+)
+EMBEDDING_ONNX_PATH = os.getenv(
+    "EMBEDDING_ONNX_PATH",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "models", "gte-small-int8"
+    ),
+)
+# onnxruntime intra op threads, 0 lets onnxruntime pick from the available cores.
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "512"))
+# The maximum number of texts sent to the endpoint in a single request.
+EMBEDDING_REQUEST_CHUNK_SIZE = int(os.getenv("EMBEDDING_REQUEST_CHUNK_SIZE", "64"))
+# The maximum number of concurrent endpoint requests, match the serverless concurrency.
+EMBEDDING_REQUEST_CONCURRENCY = int(os.getenv("EMBEDDING_REQUEST_CONCURRENCY", "3"))
+
+# In process LRU settings.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+# Optional persistent tier, one of "none", "file", or "postgres".
+EMBEDDING_CACHE_PERSISTENT = os.getenv("EMBEDDING_CACHE_PERSISTENT", "none")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite")
+EMBEDDING_CACHE_PERSISTENT_TTL_SECONDS = float(
+    os.getenv("EMBEDDING_CACHE_PERSISTENT_TTL_SECONDS", str(30 * 24 * 60 * 60))
+)
+
+
+def get_sagemaker_runtime():
+    """Get the shared sagemaker runtime client, boto3 is only imported on first use."""
+    return get_boto3_client("sagemaker-runtime")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different questions share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(
+    text: str,
+    model: str = EMBEDDING_MODEL,
+    backend: str = EMBEDDING_BACKEND,
+    quantization: str = EMBEDDING_QUANTIZATION,
+) -> str:
+    """Build the cache key from the normalized text and what computed the embedding."""
+    return hashlib.sha256(
+        f"{model}\x00{backend}\x00{quantization}\x00{normalize_text(text)}".encode()
+    ).hexdigest()
+
+
+class LRUCache:
+    """A thread safe LRU cache with a maximum size and a time to live.
+
+    :param max_size: The maximum number of entries to hold.
+    :param ttl_seconds: Entries older than this are treated as missing.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, stored_at = item
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class FileEmbeddingStore:
+    """Persist embeddings in a local sqlite file.
+
+    On lambda this lives in /tmp and is shared by warm invocations of a container.
+    Point it at a shared volume to share it between containers.
+
+    :param path: The path of the sqlite file.
+    :param ttl_seconds: Entries older than this are treated as missing.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(key TEXT PRIMARY KEY, model TEXT, embedding TEXT, created_at REAL)"
+        )
+        self._conn.commit()
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT embedding FROM embedding_cache WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl_seconds),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, key: str, model: str, embedding: List[float]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?)",
+                (key, model, json.dumps(embedding), time.time()),
+            )
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[List[float]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, model: str, embedding: List[float]):
+        await asyncio.to_thread(self._put, key, model, embedding)
+
+
+class PostgresEmbeddingStore:
+    """Persist embeddings in the `embedding_cache` table so every container shares them.
+
+    The table is created by setup_db.py. If it doesn't exist the store disables itself
+    rather than failing the request.
+
+    :param ttl_seconds: Entries older than this are treated as missing.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.enabled = True
+
+    async def get(self, key: str) -> Optional[List[float]]:
+        if not self.enabled:
+            return None
+        try:
+            pool = await get_async_pool()
+            embedding = await pool.fetchval(
+                "SELECT embedding FROM embedding_cache WHERE key = $1 "
+                "AND created_at > now() - make_interval(secs => $2)",
+                key,
+                self.ttl_seconds,
+            )
+        except asyncpg.PostgresError as e:
+            print(f"Disabling the postgres embedding cache: {e}")
+            self.enabled = False
+            return None
+        return vector_to_list(embedding) if embedding is not None else None
+
+    async def put(self, key: str, model: str, embedding: List[float]):
+        if not self.enabled:
+            return
+        try:
+            pool = await get_async_pool()
+            await pool.execute(
+                "INSERT INTO embedding_cache (key, model, embedding) VALUES ($1, $2, $3) "
+                "ON CONFLICT (key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = now()",
+                key,
+                model,
+                embedding,
+            )
+        except asyncpg.PostgresError as e:
+            print(f"Disabling the postgres embedding cache: {e}")
+            self.enabled = False
+
+
+class EmbeddingCache:
+    """A two tier embedding cache, an in process LRU backed by an optional persistent store.
+
+    :param max_size: The maximum number of embeddings held in memory.
+    :param ttl_seconds: How long an embedding stays in memory.
+    :param store: An optional persistent store with async `get(key)` and
+        `put(key, model, embedding)` methods.
+    :param model: The model name, part of every cache key.
+    :param backend: The embedding backend, part of every cache key.
+    :param quantization: The weights the backend runs, part of every cache key.
+    """
+
+    def __init__(
+        self,
+        max_size: int = EMBEDDING_CACHE_SIZE,
+        ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS,
+        store=None,
+        model: str = EMBEDDING_MODEL,
+        backend: str = EMBEDDING_BACKEND,
+        quantization: str = EMBEDDING_QUANTIZATION,
+    ):
+        self.memory = LRUCache(max_size, ttl_seconds)
+        self.store = store
+        self.model = model
+        self.backend = backend
+        self.quantization = quantization
+        self.counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    async def get(self, text: str) -> Optional[List[float]]:
+        key = cache_key(text, self.model, self.backend, self.quantization)
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            self._count("memory_hits")
+            return embedding
+        if self.store is not None:
+            embedding = await self.store.get(key)
+            if embedding is not None:
+                self._count("persistent_hits")
+                self.memory.put(key, embedding)
+                return embedding
+        self._count("misses")
+        return None
+
+    async def put(self, text: str, embedding: List[float]):
+        key = cache_key(text, self.model, self.backend, self.quantization)
+        self.memory.put(key, embedding)
+        if self.store is not None:
+            await self.store.put(key, self.model, embedding)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_rate"] = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        stats["memory_size"] = len(self.memory)
+        stats["persistent"] = type(self.store).__name__ if self.store else None
+        return stats
+
+
+def _create_store():
+    if EMBEDDING_CACHE_PERSISTENT == "file":
+        return FileEmbeddingStore(
+            EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_PERSISTENT_TTL_SECONDS
+        )
+    if EMBEDDING_CACHE_PERSISTENT == "postgres":
+        return PostgresEmbeddingStore(EMBEDDING_CACHE_PERSISTENT_TTL_SECONDS)
+    return None
+
+
+EMBEDDING_CACHE = EmbeddingCache(store=_create_store())
+
+
+def invoke_embedding_endpoint(query: str) -> List[float]:
+    """Embed a single piece of text with the sagemaker endpoint."""
+    input_data = {"text": query}
+    response = get_sagemaker_runtime().invoke_endpoint(
+        EndpointName=EMBEDDING_ENDPOINT,
+        ContentType="application/json",
+        Body=json.dumps(input_data),
+    )
+    return json.loads(response["Body"].read().decode())
+
+
+def invoke_embedding_endpoint_batch(texts: List[str]) -> List[List[float]]:
+    """Embed a list of texts with a single call to the sagemaker endpoint."""
+    response = get_sagemaker_runtime().invoke_endpoint(
+        EndpointName=EMBEDDING_ENDPOINT,
+        ContentType="application/json",
+        Body=json.dumps({"texts": texts}),
+    )
+    return json.loads(response["Body"].read().decode())
+
+
+class SageMakerEmbeddingBackend:
+    """Embeds texts with the serverless sagemaker endpoint."""
+
+    name = "sagemaker"
+
+    def load(self):
+        """Create the boto3 client, the endpoint itself is only called when embedding."""
+        get_sagemaker_runtime()
+
+    def embed_one(self, text: str) -> List[float]:
+        return invoke_embedding_endpoint(text)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return invoke_embedding_endpoint_batch(texts)
+
+
+class LocalEmbeddingBackend:
+    """Embeds texts in process with an int8 quantized ONNX export of gte-small.
+
+    The model is loaded once per container on first use. Like the sentence-transformers
+    model behind the endpoint the token embeddings are mean pooled over the attention
+    mask, the vectors are also L2 normalized which leaves cosine distances unchanged.
+
+    :param path: The directory holding model.onnx and tokenizer.json.
+    :param threads: The onnxruntime intra op threads, 0 for the onnxruntime default.
+    :param max_tokens: Longer texts are truncated, gte-small was trained on 512 tokens.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_ONNX_PATH,
+        threads: int = EMBEDDING_ONNX_THREADS,
+        max_tokens: int = EMBEDDING_MAX_TOKENS,
+    ):
+        self.path = path
+        self.threads = threads
+        self.max_tokens = max_tokens
+        self._session = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the tokenizer and the ONNX session if they aren't loaded yet."""
+        with self._lock:
+            if self._session is not None:
+                return
+            # Only needed by this backend so they aren't installed with the sagemaker one.
+            import onnxruntime
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(os.path.join(self.path, "tokenizer.json"))
+            tokenizer.enable_truncation(self.max_tokens)
+            tokenizer.enable_padding()
+            options = onnxruntime.SessionOptions()
+            if self.threads:
+                options.intra_op_num_threads = self.threads
+            start = time.perf_counter()
+            self._session = onnxruntime.InferenceSession(
+                os.path.join(self.path, "model.onnx"),
+                options,
+                providers=["CPUExecutionProvider"],
+            )
+            self._tokenizer = tokenizer
+            print(f"Loaded {self.path} in {time.perf_counter() - start:.2f}s")
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        self.load()
+        encodings = self._tokenizer.encode_batch(texts)
+        features = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array(
+                [e.attention_mask for e in encodings], dtype=np.int64
+            ),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        inputs = {i.name: features[i.name] for i in self._session.get_inputs()}
+        token_embeddings = self._session.run(None, inputs)[0]
+        mask = features["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(
+            mask.sum(axis=1), 1e-9, None
+        )
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_one(self, text: str) -> List[float]:
+        return self.embed([text])[0]
+
+
+EMBEDDING_BACKENDS = {
+    "sagemaker": SageMakerEmbeddingBackend,
+    "local": LocalEmbeddingBackend,
+}
+_EMBEDDING_BACKEND = None
+
+
+def get_embedding_backend():
+    """Get the module level embedding backend selected by EMBEDDING_BACKEND."""
+    global _EMBEDDING_BACKEND
+    if _EMBEDDING_BACKEND is None:
+        if EMBEDDING_BACKEND not in EMBEDDING_BACKENDS:
+            raise ValueError(
+                f"Unknown EMBEDDING_BACKEND {EMBEDDING_BACKEND}, "
+                f"expected one of {', '.join(EMBEDDING_BACKENDS)}"
+            )
+        _EMBEDDING_BACKEND = EMBEDDING_BACKENDS[EMBEDDING_BACKEND]()
+    return _EMBEDDING_BACKEND
+
+
+async def get_embeddings(
+    texts: List[str], chunk_size: int = EMBEDDING_REQUEST_CHUNK_SIZE
+) -> List[List[float]]:
+    """Embed many texts, only sending cache misses to the embedding backend in chunks.
+
+    Up to EMBEDDING_REQUEST_CONCURRENCY chunks are sent concurrently.
+
+    :param texts: The texts to embed.
+    :param chunk_size: The maximum number of texts per endpoint request.
+    :return: One embedding per text in the same order as `texts`.
+    """
+    embeddings: List[Optional[List[float]]] = await asyncio.gather(
+        *[EMBEDDING_CACHE.get(t) for t in texts]
+    )
+    # Deduplicate the misses so repeated texts are only embedded once.
+    missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    chunks = [missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    semaphore = asyncio.Semaphore(EMBEDDING_REQUEST_CONCURRENCY)
+
+    async def embed_chunk(chunk: List[str]) -> List[List[float]]:
+        async with semaphore:
+            return await asyncio.to_thread(get_embedding_backend().embed, chunk)
+
+    results = await asyncio.gather(*[embed_chunk(c) for c in chunks])
+    computed = {}
+    for chunk, chunk_embeddings in zip(chunks, results):
+        for text, embedding in zip(chunk, chunk_embeddings):
+            await EMBEDDING_CACHE.put(text, embedding)
+            computed[text] = embedding
+    return [e if e is not None else computed[t] for t, e in zip(texts, embeddings)]
+
+
+async def get_embedding(query: str) -> List[float]:
+    """Embed a piece of text, checking the embedding cache before the backend.
+
+    Both backends are synchronous (boto3 and onnxruntime) so they run in a worker
+    thread and the event loop stays free for other requests.
+    """
+    embedding = await EMBEDDING_CACHE.get(query)
+    if embedding is None:
+        embedding = await asyncio.to_thread(get_embedding_backend().embed_one, query)
+        await EMBEDDING_CACHE.put(query, embedding)
+    return embedding
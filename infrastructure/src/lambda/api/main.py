@@ -1,17 +1,53 @@
-from fastapi import FastAPI
-from mangum import Mangum
-import uvicorn
-from typing import Any, Dict, List, Optional
-from psycopg2.extras import execute_values
-from pgvector.psycopg2 import register_vector
-import psycopg2
-from psycopg2 import OperationalError
-import boto3
+from coldstart import COLD_START, prewarm_steps
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException
+from fastapi.responses import Response
+from typing import Any, Awaitable, Dict, List, Optional
+import asyncio
+import asyncpg
+import functools
+import hashlib
 import json
 import os
-from openai import OpenAI
+import time
 import traceback
 from pydantic import BaseModel
+from clients import get_openai_client, loaded_clients
+from db import get_async_pool, statement_timeout, to_row
+from answer_cache import ANSWER_CACHE
+from columnar import columnar_format, columnar_sql, rows_to_columnar
+from cost_guard import COST_GUARD, GuardDecision, QueryRejected
+from metrics import (
+    PROMETHEUS_MEDIA_TYPE,
+    PROMPT_TOKENS,
+    REGISTRY,
+    SPECULATION,
+    SPECULATION_SAVED_SECONDS,
+    event,
+    record,
+    set_path,
+    span,
+    timed,
+    traced,
+)
+from embeddings import (
+    EMBEDDING_BACKEND,
+    EMBEDDING_CACHE,
+    get_embedding,
+    get_embedding_backend,
+    get_embeddings,
+)
+from pagination import PAGINATOR, InvalidPageToken, page_response, run_page
+from query_log import QUERY_LOG_FLUSH_AT_RESPONSE_END, QUERY_LOGGER
+from result_cache import RESULT_CACHE
+from schema import SCHEMA_CACHE
+from schema_index import SCHEMA_INDEX
+from streaming import STREAM_ITERSIZE, stream_sql, wants_ndjson
+from template_index import TEMPLATE_INDEX
+from templates import (
+    TemplateError,
+    check_template,
+    compile_template,
+)
 
 
 class ChatSQLOutput(BaseModel):
@@ -19,35 +55,14 @@ class ChatSQLOutput(BaseModel):
     notes: str
 
 
-OPENAI_CLIENT = OpenAI(
-    # This is the default and can be omitted
-    api_key=os.environ.get("OPENAI_API_KEY"),
-)
-
-
-CREDENTIALS = {
-    "password": os.getenv("DB_PASSWORD", "Tvzh*f]uvxX?`y(L$u`Vyra&b6P9VQQ4"),
-    "host": os.getenv(
-        "DB_HOST",
-        "mainstackrdsstackb4b88b4d-postgresvectordb82399e33-adgdgkmbo427.cbas6w2cunpd.us-west-2.rds.amazonaws.com",
-    ),
-    "port": os.getenv("DB_PORT", "1053"),
-}
-
 SQL_PROMPT = """
-I ran this query on my database:
+These are the tables in my database, one per line as `schema.table: column type, ...`:
 
 ```
-{table_query}
+{schema_context}
 ```
 
- and got the following result:
-
- ```
- {table_results}
- ```
-
-As a senior analyst working in postgres, given the above schemas and data, write a detailed and correct postgres query to answer the analytical question:
+As a senior analyst working in postgres, given the above schemas, write a detailed and correct postgres query to answer the analytical question:
 
 {user_query}
 
@@ -59,79 +74,168 @@ Your output should be structured as follows:
 Make sure the `sql_query` is a valid SQL query and contains no comments or additional text.
 """
 
+# Search parameters for the ANN index on queries.embedding. Leave unset to use the
+# postgres defaults (hnsw.ef_search=40, ivfflat.probes=1).
+VECTOR_EF_SEARCH = (
+    int(os.getenv("VECTOR_EF_SEARCH")) if os.getenv("VECTOR_EF_SEARCH") else None
+)
+VECTOR_PROBES = int(os.getenv("VECTOR_PROBES")) if os.getenv("VECTOR_PROBES") else None
+
+# Templates closer than this cosine distance to the question are offered to the LLM as
+# tools before falling back to generating the SQL.
+TEMPLATE_MAX_DISTANCE = float(os.getenv("TEMPLATE_MAX_DISTANCE", "0.1"))
+# When the closest template's distance is in [SPECULATIVE_MIN_DISTANCE,
+# SPECULATIVE_MAX_DISTANCE) try the template and generate the SQL at the same time. The
+# first result wins, the other LLM call is cancelled but usually still billed.
+SPECULATIVE_ENABLED = os.getenv("SPECULATIVE_ENABLED", "false").lower() == "true"
+SPECULATIVE_MIN_DISTANCE = float(os.getenv("SPECULATIVE_MIN_DISTANCE", "0.05"))
+SPECULATIVE_MAX_DISTANCE = float(os.getenv("SPECULATIVE_MAX_DISTANCE", "0.15"))
+
+# The columns returned by get_similar and their postgres types, used for the Arrow and
+# Parquet output of /find.
+SIMILAR_COLUMNS = {
+    "name": "text",
+    "query": "text",
+    "args": "_text",
+    "arg_types": "_text",
+    "similarity": "float8",
+}
+
 
-def add_query_to_db(conn, query: str, args: List[str], embedding: List[float]):
-    # Add queries to the database
-    # Batch insert embeddings and metadata from dataframe into PostgreSQL database
-    register_vector(conn)
-    cur = conn.cursor()
-    # Prepare the list of tuples to insert
-    data_list = [(query, "{" + ",".join([f'"{x}"' for x in args]) + "}", embedding)]
-    # Use execute_values to perform batch insertion
-    execute_values(
-        cur, "INSERT INTO queries (query, args, embedding) VALUES %s", data_list
-    )
-    # Commit after we insert all embeddings
-    conn.commit()
+# /add/bulk accepts at most this many queries per request and writes them with one COPY
+# per chunk, all in the same transaction.
+BULK_ADD_MAX_QUERIES = int(os.getenv("BULK_ADD_MAX_QUERIES", "10000"))
+BULK_ADD_CHUNK_SIZE = int(os.getenv("BULK_ADD_CHUNK_SIZE", "1000"))
+QUERY_COLUMNS = ["name", "query", "args", "arg_types", "embedding"]
 
 
-def create_connection(host: str, port: str, password: str):
-    """Create a database connection using psycopg2 with SSL using environment variables."""
-    connection = None
-    try:
-        connection = psycopg2.connect(
-            host=host,
-            port=port,
-            dbname="postgres",
-            user="postgres",  # use the dbuser with iam auth!
-            password=password,
+BUMP_QUERIES_VERSION = """
+INSERT INTO table_versions (table_name, version) VALUES ('queries', 1)
+ON CONFLICT (table_name)
+DO UPDATE SET version = table_versions.version + 1, updated_at = now()
+"""
+
+
+async def add_queries_to_db(
+    conn, rows: List[tuple], chunk_size: int = BULK_ADD_CHUNK_SIZE
+):
+    """Add queries to the database in a single transaction, one COPY per chunk.
+
+    :param conn: An asyncpg connection.
+    :param rows: (name, query, args, arg_types, embedding) tuples.
+    :param chunk_size: The most rows per COPY.
+    """
+    async with conn.transaction():
+        for i in range(0, len(rows), chunk_size):
+            await conn.copy_records_to_table(
+                "queries", records=rows[i : i + chunk_size], columns=QUERY_COLUMNS
+            )
+        # Drop the cached results reading from queries, like setup_db.py does on a reload.
+        if await conn.fetchval("SELECT to_regclass('public.table_versions')"):
+            await conn.execute(BUMP_QUERIES_VERSION)
+
+
+async def get_similar(
+    query_embedding,
+    conn,
+    n: int = 3,
+    ef_search: Optional[int] = VECTOR_EF_SEARCH,
+    probes: Optional[int] = VECTOR_PROBES,
+):
+    async with conn.transaction():
+        # Trade recall for latency on the ANN index. These only last for this transaction.
+        if ef_search is not None:
+            await conn.execute(
+                "SELECT set_config('hnsw.ef_search', $1, true)", str(ef_search)
+            )
+        if probes is not None:
+            await conn.execute(
+                "SELECT set_config('ivfflat.probes', $1, true)", str(probes)
+            )
+        # Get the most similar words using the KNN <=> operator
+        rows = await conn.fetch(
+            "SELECT name, query, args, arg_types, (embedding <=> $1) as similarity FROM queries ORDER BY similarity LIMIT $2",
+            query_embedding,
+            n,
         )
-        print("Secure connection to PostgreSQL DB successful")
-    except OperationalError as e:
-        print(f"The error '{e}' occurred")
-    return connection
-
-
-def get_embedding(query: str):
-    runtime = boto3.client("sagemaker-runtime")
-    input_data = {"text": query}
-    response = runtime.invoke_endpoint(
-        EndpointName="query-embedding",
-        ContentType="application/json",
-        Body=json.dumps(input_data),
-    )
-    return json.loads(response["Body"].read().decode())
-
-
-def get_similar(query_embedding, conn, n: int = 3):
-    embedding_str = f'[{", ".join(map(str, query_embedding))}]'
-    # Register pgvector extension
-    register_vector(conn)
-    cur = conn.cursor()
-    # Get the most similar words using the KNN <=> operator
-    cur.execute(
-        f"SELECT name, query, args, arg_types, (embedding <=> %s) as similarity FROM queries ORDER BY similarity LIMIT {n}",
-        (embedding_str,),
-    )
-    return cur.fetchall()
+    return [to_row(r) for r in rows]
 
 
-def call_db(query: str, **kwargs):
-    """This function is a universal DB call.
+async def search_templates(
+    pool,
+    embedding: List[float],
+    n: int = 3,
+    ef_search: Optional[int] = VECTOR_EF_SEARCH,
+    probes: Optional[int] = VECTOR_PROBES,
+):
+    """Find the stored queries closest to an embedding.
 
-    It works by allowing partial application of SQL queries with defined arguments.
+    Uses the in memory template index when it's enabled, which only touches postgres
+    to look for new templates, and pgvector otherwise. Both give the same distances.
     """
-    query = query.format(**kwargs)
-    conn = create_connection(**CREDENTIALS)
-    try:
-        cur = conn.cursor()
-        cur.execute(query)
-        result = cur.fetchall()
-        return result
-    except:
-        pass
-    finally:
-        conn.close()
+    if TEMPLATE_INDEX.enabled:
+        await TEMPLATE_INDEX.refresh(pool)
+        return TEMPLATE_INDEX.search(embedding, n)
+    async with pool.acquire() as conn:
+        return await get_similar(
+            embedding, conn, n=n, ef_search=ef_search, probes=probes
+        )
+
+
+async def run_sql(sql: str, *args: Any) -> List[tuple]:
+    """Run a SQL statement on a pooled connection and return all rows.
+
+    Read only results are served from the result cache while their tables are unchanged.
+    Statements with $n parameters are prepared once per connection and reused.
+    """
+    pool = await get_async_pool()
+    out = await RESULT_CACHE.get(pool, sql, args)
+    if out is not None:
+        return out
+    cacheable = RESULT_CACHE.cacheable(sql)
+    async with pool.acquire() as conn:
+        if cacheable:
+            # A result is only cached if the statement runs read only, e.g. a WITH
+            # holding a DELETE fails here and runs again outside the cache.
+            try:
+                async with conn.transaction(readonly=True):
+                    rows = await conn.fetch(sql, *args)
+            except asyncpg.ReadOnlySQLTransactionError:
+                cacheable = False
+                # It writes, so cached results may be stale.
+                RESULT_CACHE.clear()
+        if not cacheable:
+            rows = await conn.fetch(sql, *args)
+    out = [to_row(r) for r in rows]
+    if cacheable:
+        RESULT_CACHE.put(sql, out, args)
+    return out
+
+
+async def get_schema_context() -> str:
+    """Get the cached schema context, refreshing it when the schema changed."""
+    return await SCHEMA_CACHE.get(await get_async_pool())
+
+
+async def guard_sql(sql: str) -> GuardDecision:
+    """Check generated SQL against the cost guard's budget before it's run."""
+    with span("guard"), statement_timeout(COST_GUARD.statement_timeout_ms):
+        decision = await COST_GUARD.check(await get_async_pool(), sql)
+    event(f"guard_{decision.action}")
+    return decision
+
+
+async def run_guarded(execute, decision: GuardDecision, stage: str = "execute"):
+    """Run generated SQL the cost guard let through, under its statement timeout."""
+    if decision.error is not None:
+        raise QueryRejected(f"The query couldn't be planned: {decision.error}")
+    if decision.action == "rejected":
+        raise QueryRejected(
+            f"The query is too expensive to run, {decision.reason}. Add filters or "
+            "aggregate the data so it reads and returns fewer rows."
+        )
+    with span(stage), statement_timeout(COST_GUARD.statement_timeout_ms):
+        return await execute(decision.sql)
 
 
 def format_query_spec_to_openai_tool(
@@ -157,181 +261,399 @@ def format_query_spec_to_openai_tool(
     return func_spec
 
 
+COLD_START.mark("imports")
 app = FastAPI()
-handler = Mangum(app, lifespan="off")
+_HANDLER = None
+
+
+def handler(event, context):
+    """The lambda entry point, mangum is only imported by the first invocation."""
+    global _HANDLER
+    if _HANDLER is not None:
+        return _HANDLER(event, context)
+    from mangum import Mangum
+
+    start = time.perf_counter()
+    _HANDLER = Mangum(app, lifespan="off")
+    response = _HANDLER(event, context)
+    COLD_START.record_first_request(time.perf_counter() - start)
+    COLD_START.log()
+    return response
+
+
+async def prewarm(steps: List[str]):
+    """Do the work usually left to the first request ahead of it, see PREWARM.
+
+    A step which fails is logged and skipped, the request will try again.
+    """
+    for step in steps:
+        try:
+            if step == "pool":
+                # The pool opens connections lazily so check one out to open it.
+                pool = await get_async_pool()
+                async with pool.acquire():
+                    pass
+            elif step == "schema":
+                await get_schema_context()
+                if SCHEMA_INDEX.enabled:
+                    await SCHEMA_INDEX.sync(
+                        await get_async_pool(), SCHEMA_CACHE.version
+                    )
+            elif step == "templates":
+                if TEMPLATE_INDEX.enabled:
+                    await TEMPLATE_INDEX.refresh(await get_async_pool())
+            elif step == "embedding":
+                await asyncio.to_thread(get_embedding_backend().load)
+            elif step == "openai":
+                get_openai_client()
+        except Exception:
+            print(traceback.format_exc())
+        COLD_START.mark(f"prewarm_{step}")
+
+
+@app.on_event("startup")
+async def prewarm_on_startup():
+    # Only fires under uvicorn, on lambda prewarming runs while the module is imported.
+    await prewarm(prewarm_steps())
+    COLD_START.log()
+
+
+@app.on_event("shutdown")
+async def flush_query_log():
+    # Only fires under uvicorn, on lambda the logger flushes on SIGTERM.
+    await QUERY_LOGGER.flush()
 
 
 class QueryRequest(BaseModel):
     query: str
+    # Allow reusing the SQL of a near identical question answered before.
+    use_answer_cache: bool = True
+    # Rows fetched per round trip when streaming NDJSON, or per Arrow record batch.
+    itersize: int = STREAM_ITERSIZE
+    # Return results a page at a time. Pass the next_page_token of a page back as
+    # page_token to get the following page.
+    limit: Optional[int] = None
+    page_token: Optional[str] = None
 
 
 class AddQuery(BaseModel):
     query: str
     args: List[str]
+    # The tool name the LLM picks the query by, derived from the query if not given.
+    name: Optional[str] = None
+    # The JSON schema type of each arg, strings if not given.
+    arg_types: Optional[List[str]] = None
+
+
+class BulkAddQueries(BaseModel):
+    queries: List[AddQuery]
+
+
+async def stored_names(conn, names: List[str]) -> set:
+    """Get the names out of `names` which are already stored in queries."""
+    rows = await conn.fetch("SELECT name FROM queries WHERE name = ANY($1)", names)
+    return {r["name"] for r in rows}
+
+
+def query_name(query: AddQuery) -> str:
+    if query.name is not None:
+        return query.name
+    return "query_" + hashlib.sha1(query.query.encode()).hexdigest()[:12]
+
+
+async def add_queries(queries: List[AddQuery]) -> Dict[str, Any]:
+    """Check, embed and store query templates, reporting a status for each one.
+
+    Invalid queries and queries whose name is already taken (in postgres or earlier in
+    the request) are skipped, the rest are embedded in batches and inserted together.
+    """
+    results: List[Dict[str, Any]] = []
+    # index -> (name, query, args, arg_types) of the queries that passed the checks
+    valid: Dict[int, tuple] = {}
+    with span("validate"):
+        seen = set()
+        for i, q in enumerate(queries):
+            name = query_name(q)
+            arg_types = (
+                q.arg_types if q.arg_types is not None else ["string"] * len(q.args)
+            )
+            result = {"index": i, "name": name, "status": "inserted"}
+            try:
+                check_template(name, q.query, q.args, arg_types)
+            except TemplateError as e:
+                result.update(status="invalid", error=str(e))
+            else:
+                if name in seen:
+                    result.update(
+                        status="duplicate", error="name used earlier in request"
+                    )
+                else:
+                    valid[i] = (name, q.query, q.args, arg_types)
+                seen.add(name)
+            results.append(result)
+        # Skip embedding names which are already stored. This is only a shortcut, the
+        # unique index on queries(name) decides when the rows are inserted.
+        pool = await get_async_pool()
+        taken = await stored_names(pool, [results[i]["name"] for i in valid])
+        for i in list(valid):
+            if results[i]["name"] in taken:
+                results[i].update(status="duplicate", error="name already stored")
+                del valid[i]
+
+    if valid:
+        # Embedd the sql in batches, only cache misses go to the embedding backend.
+        with span("embedding"):
+            embeddings = await get_embeddings([row[1] for row in valid.values()])
+        rows = {i: row + (e,) for (i, row), e in zip(valid.items(), embeddings)}
+        # Update Vector Table with new SQL queries and embeddings
+        with span("insert"):
+            async with pool.acquire() as conn:
+                while rows:
+                    try:
+                        await add_queries_to_db(conn, list(rows.values()))
+                        break
+                    except asyncpg.UniqueViolationError:
+                        # A concurrent request stored some of the names since the
+                        # check above. Nothing was inserted, retry without them.
+                        taken = await stored_names(conn, [r[0] for r in rows.values()])
+                        if not taken:
+                            raise
+                        for i in [i for i, row in rows.items() if row[0] in taken]:
+                            results[i].update(
+                                status="duplicate", error="name already stored"
+                            )
+                            del rows[i]
+        TEMPLATE_INDEX.mark_changed()
+
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return {"counts": counts, "results": results}
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"status": "healthy"}
 
 
+@app.get("/stats")
+async def get_stats():
+    """Report connection pool and cache statistics."""
+    async_pool = await get_async_pool()
+    return {
+        "async_pool": {
+            "size": async_pool.get_size(),
+            "idle": async_pool.get_idle_size(),
+            "max_size": async_pool.get_max_size(),
+        },
+        "cold_start": COLD_START.report(),
+        "clients": loaded_clients(),
+        "embedding_backend": EMBEDDING_BACKEND,
+        "embedding_cache": EMBEDDING_CACHE.stats(),
+        "schema_cache": SCHEMA_CACHE.stats(),
+        "schema_index": SCHEMA_INDEX.stats(),
+        "template_index": TEMPLATE_INDEX.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "pagination": PAGINATOR.stats(),
+        "query_log": QUERY_LOGGER.stats(),
+        "cost_guard": COST_GUARD.stats(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Report request and stage latencies in the Prometheus text format."""
+    return Response(REGISTRY.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+
 @app.get("/test")
-def test_db_connection():
-    # Get the credentials and connect to the database
-    conn = create_connection(**CREDENTIALS)
-    cur = conn.cursor()
-    cur.execute(f"SELECT * FROM queries LIMIT 5")
-    res = cur.fetchall()
-    conn.close()
-    return res
+async def test_db_connection(
+    itersize: int = STREAM_ITERSIZE, accept: Optional[str] = Header(None)
+):
+    # Borrow a connection from the pool
+    if wants_ndjson(accept):
+        return await stream_sql("SELECT * FROM queries LIMIT 5", itersize=itersize)
+    return await run_sql("SELECT * FROM queries LIMIT 5")
 
 
 @app.post("/add")
-def add_query(query: AddQuery):
+@traced("add")
+async def add_query(query: AddQuery):
     """Adds a query to the database."""
-    # Embedd sql
-    embedding = get_embedding(query.query)
+    result = (await add_queries([query]))["results"][0]
+    if result["status"] != "inserted":
+        raise HTTPException(status_code=400, detail=result["error"])
 
-    # Get the credentials and connect to the database
-    conn = create_connection(**CREDENTIALS)
+    # Return True if added
+    return {"status": "success", "name": result["name"]}
 
-    # Update Vector Table with new SQL query and embedding
-    add_query_to_db(conn, query.query, query.args, embedding)
-    conn.close()
 
-    # Return True if added
-    return {"status": "success"}
+@app.post("/add/bulk")
+@traced("add_bulk")
+async def add_queries_bulk(request: BulkAddQueries):
+    """Adds many queries to the database at once, e.g. a new domain's templates.
+
+    Returns the status of each query in request order, "inserted", "invalid" or
+    "duplicate". Either every valid query is stored or, if postgres fails, none are.
+    """
+    if len(request.queries) > BULK_ADD_MAX_QUERIES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {BULK_ADD_MAX_QUERIES} queries per request",
+        )
+    return await add_queries(request.queries)
 
 
 @app.get("/find")
-def find_query(query: str, n: int = 5):
-    """Adds a query to the database."""
+@traced("find")
+async def find_query(
+    query: str,
+    n: int = 5,
+    ef_search: Optional[int] = VECTOR_EF_SEARCH,
+    probes: Optional[int] = VECTOR_PROBES,
+    accept: Optional[str] = Header(None),
+):
+    """Finds the stored queries most similar to the request."""
     # Embedd request
-    embedding = get_embedding(query)
-
-    # Auth with database
-    conn = create_connection(**CREDENTIALS)
+    with span("embedding"):
+        embedding = await get_embedding(query)
 
     # Query Table for similar queries
-    result = get_similar(embedding, conn, n=n)
-    conn.close()
+    with span("vector_search"):
+        pool = await get_async_pool()
+        result = await search_templates(
+            pool, embedding, n=n, ef_search=ef_search, probes=probes
+        )
+    fmt = columnar_format(accept)
+    if fmt is not None:
+        with span("encode"):
+            return rows_to_columnar(result, SIMILAR_COLUMNS, fmt)
     return result
 
 
-@app.post("/query")
-def query_with_language(query: QueryRequest):
-    # Determine if we should use function calling
-    embedding = get_embedding(query.query)
+def record_prompt_tokens(result, schema: str):
+    """Record the prompt tokens of an LLM call, if the response reports its usage."""
+    usage = getattr(result, "usage", None)
+    if usage is None:
+        return
+    PROMPT_TOKENS.observe(usage.prompt_tokens, "query", schema)
+    record("prompt_tokens", usage.prompt_tokens)
 
-    # Auth with database
-    conn = create_connection(**CREDENTIALS)
 
-    # Query Table for similar queries
-    similar_sql_queries = get_similar(embedding, conn, n=5)
+async def answer_with_template(
+    query: QueryRequest, similar_sql_queries: List[tuple], execute
+) -> Optional[Any]:
+    """Let the LLM pick one of the similar templates and fill in its args.
 
+    :return: The result of the template or None if none of them fits and the SQL has to
+        be generated instead.
+    """
     # Do Function Calling
     # FIXME:: THE OUTPUT OF GET SIMILAR SHOULD REALLY BE A SENSIBLE DICT LOL.....
-    print(similar_sql_queries)
-    if similar_sql_queries[0][-1] < 0.1:
-        # Create the tool specs
-        tools = [
-            format_query_spec_to_openai_tool(q[0], q[1], q[2], q[3])
-            for q in similar_sql_queries
-        ]
-        # Run the function call
-        messages = [
-            {"role": "system", "content": ""},
-            {
-                "role": "user",
-                "content": f"{query} use your best judgement.",
-            },
-        ]
-        chat_out = OPENAI_CLIENT.chat.completions.create(
+    # Create the tool specs
+    tools = [
+        format_query_spec_to_openai_tool(q[0], q[1], q[2], q[3])
+        for q in similar_sql_queries
+    ]
+    # Run the function call
+    messages = [
+        {"role": "system", "content": ""},
+        {
+            "role": "user",
+            "content": f"{query.query} use your best judgement.",
+        },
+    ]
+    with span("tool_call"):
+        chat_out = await get_openai_client().chat.completions.create(
             model="gpt-4-turbo", messages=messages, tools=tools
         )
-        finish_reason = chat_out.choices[0].finish_reason
-        fn_name = chat_out.choices[0].message.tool_calls[0].function.name
-        print(chat_out)
-        if finish_reason == "tool_calls":
-            for res in similar_sql_queries:
-                if res[0] == fn_name:
-                    # FIXME:: Types aren't perfect. GPT doesn't know when to use float or number.
-                    #   This could probably be solved with better variable names
-                    fn_query = (
-                        res[1]
-                        .strip()
-                        .format(
-                            **json.loads(
-                                chat_out.choices[0]
-                                .message.tool_calls[0]
-                                .function.arguments
-                            )
-                        )
-                    )
-                    conn = create_connection(**CREDENTIALS)
-                    cur = conn.cursor()
-                    cur.execute(fn_query)
-                    out = cur.fetchall()
-                    conn.close()
-                    print(chat_out.choices[0].message.tool_calls[0].function.arguments)
-                    return out
-
+    finish_reason = chat_out.choices[0].finish_reason
+    print(chat_out)
+    if finish_reason != "tool_calls":
+        event("fallback_no_tool_call")
+        return None
+    fn_name = chat_out.choices[0].message.tool_calls[0].function.name
+    fn_args = json.loads(chat_out.choices[0].message.tool_calls[0].function.arguments)
+    for res in similar_sql_queries:
+        if res[0] == fn_name:
+            # Bind the arguments as parameters of a statement prepared once per
+            # connection. Values which don't fit the arg types, the whitelist or the
+            # parameter types postgres infers, e.g. 0.8 for a bigint column, fall back
+            # to generating the SQL.
+            try:
+                fn_query, binds = compile_template(res[1], res[2], res[3]).render(
+                    fn_args
+                )
+            except TemplateError:
+                print(traceback.format_exc())
+                event("fallback_template_error")
+                return None
+            set_path("template")
+            try:
+                with span("execute"):
+                    out = await execute(fn_query, *binds)
+            except asyncpg.PostgresError:
+                print(traceback.format_exc())
+                event("fallback_template_error")
+                return None
+            print(fn_args)
+            return out
+    return None
+
+
+async def answer_with_llm(
+    query: QueryRequest,
+    schema_context: str,
+    embedding: List[float],
+    execute,
+    background_tasks: BackgroundTasks,
+):
+    """Generate the SQL from the schema, fixing it once if it doesn't run."""
+    # Large schemas are cut down to the tables and columns closest to the question.
+    schema_label = "full"
+    if SCHEMA_INDEX.enabled:
+        with span("schema_retrieval"):
+            pruned = await SCHEMA_INDEX.context(
+                await get_async_pool(), embedding, schema_context, SCHEMA_CACHE.version
+            )
+        if pruned is not schema_context:
+            schema_label, schema_context = "pruned", pruned
+            event("schema_pruned")
+    record("schema_chars", len(schema_context))
     # If we don't find a sufficiently close query in our database OR ChatGPT
-    # decides not to do a function call we default to chatGPT running the show.
-    # First query our database to get context on ALL tables.
-    conn = create_connection(**CREDENTIALS)
-    cur = conn.cursor()
-    table_query = """
-    SELECT 
-        table_schema, 
-        table_name, 
-        column_name, 
-        data_type, 
-        is_nullable, 
-        column_default
-    FROM 
-        information_schema.columns
-    WHERE 
-        table_schema NOT IN ('information_schema', 'pg_catalog')
-    ORDER BY 
-        table_schema, 
-        table_name, 
-        ordinal_position;
-    """
-    cur.execute(table_query)
-    table_results = cur.fetchall()
-    conn.close()
-
+    # decides not to do a function call we default to chatGPT running the show
+    # with the context on ALL tables we fetched above.
     # Query ChatGPT for the sql query to run.
     messages = [
         {"role": "system", "content": ""},
         {
             "role": "user",
             "content": SQL_PROMPT.format(
-                table_query=table_query,
-                table_results=table_results,
+                schema_context=schema_context,
                 user_query=query.query,
             ),
         },
     ]
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
-    result = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06",
-        messages=messages,
-        response_format=ChatSQLOutput,
-    )
+    set_path("llm")
+    with span("sql_generation"):
+        result = await get_openai_client().beta.chat.completions.parse(
+            model="gpt-4o-2024-08-06",
+            messages=messages,
+            response_format=ChatSQLOutput,
+        )
+    record_prompt_tokens(result, schema_label)
 
-    # Run the query with one fix retry
+    # Run the query with one fix retry. The cost guard limits or rejects queries the
+    # planner expects to be too expensive, a rejection is fixed like any other error.
     # FIXME:: THIS SHOULD BE A function with configurable retries and convergence testing.
+    out = None
+    decision = None
     try:
-        conn = create_connection(**CREDENTIALS)
-        cur = conn.cursor()
-        cur.execute(json.loads(result.choices[0].message.content)["sql_query"])
-        out = cur.fetchall()
-        conn.close()
+        decision = await guard_sql(
+            json.loads(result.choices[0].message.content)["sql_query"]
+        )
+        out = await run_guarded(execute, decision)
     except Exception:
         # If we fail try and fix the query.
         e = traceback.format_exc()
@@ -346,46 +668,201 @@ def query_with_language(query: QueryRequest):
                 "content": f"This query didn't run. We got this error {e} please fix the query so that it will run.",
             }
         )
-        result = client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            response_format=ChatSQLOutput,
+        set_path("llm_retry")
+        with span("sql_retry"):
+            result = await get_openai_client().beta.chat.completions.parse(
+                model="gpt-4o-2024-08-06",
+                messages=messages,
+                response_format=ChatSQLOutput,
+            )
+        record_prompt_tokens(result, schema_label)
+        decision = await guard_sql(
+            json.loads(result.choices[0].message.content)["sql_query"]
         )
-        conn = create_connection(**CREDENTIALS)
-        cur = conn.cursor()
-        cur.execute(json.loads(result.choices[0].message.content)["sql_query"])
-        out = cur.fetchall()
-        conn.close()
+        try:
+            out = await run_guarded(execute, decision, "execute_retry")
+        except QueryRejected as e:
+            raise HTTPException(status_code=422, detail=str(e))
     finally:
-        # We want to run this saving no matter what happens so that we can debug failures
-        # Store request and response only when new things come through.
-        # FIXME:: This should be a background task for better performance. This
-        # doesn't work on lambdas since they have to exit on return so I'm not doing that
-        # here. But you'll want this as a background task if you deploy this API for realz.
-        conn = create_connection(**CREDENTIALS)
-        cur = conn.cursor()
-
-        # Example values to insert
-        sql_query = json.loads(result.choices[0].message.content)["sql_query"]
-        conversation_history = json.dumps(messages)
-
-        # Construct the SQL INSERT statement
-        insert_command = """
-        INSERT INTO user_queries (user_query, sql_query, conversation_history) 
-        VALUES (%s, %s, %s);
-        """
-
-        # Execute the command
-        cur.execute(insert_command, (query.query, sql_query, conversation_history))
-
-        # Commit the transaction and close the connection
-        conn.commit()
-        cur.close()
-        conn.close()
+        # We want to run this saving no matter what happens so that we can debug failures.
+        # Outside lambda the record is only buffered here and written in batches in the
+        # background so it doesn't add to the response time, on lambda it's inserted
+        # here. The embedding and schema version let the answer cache reuse queries
+        # which ran successfully.
+        with span("log"):
+            await QUERY_LOGGER.log(
+                user_query=query.query,
+                sql_query=json.loads(result.choices[0].message.content)["sql_query"],
+                conversation_history=json.dumps(messages),
+                embedding=embedding,
+                succeeded=out is not None,
+                schema_version=SCHEMA_CACHE.version,
+                guard_action=None if decision is None else decision.action,
+            )
+        if QUERY_LOG_FLUSH_AT_RESPONSE_END:
+            background_tasks.add_task(QUERY_LOGGER.flush)
 
     # Return Response
     return out
 
 
+async def speculate(template: Awaitable, llm: Awaitable):
+    """Run the template and LLM paths at the same time, the first result wins.
+
+    The template path giving up doesn't end the race, the LLM's result is waited for.
+    The path that's still running once there is a winner is cancelled. Without a winner
+    the LLM path's error is raised, or its empty result returned, like it would be
+    without speculation.
+
+    The latency saved is compared to trying the template first and the LLM after it.
+    It's the template path's time when it gave up, and nothing when the template won or
+    was still running when the LLM won, so it's a lower bound.
+    """
+    start = time.perf_counter()
+    tasks = {
+        asyncio.ensure_future(template): "template",
+        asyncio.ensure_future(llm): "llm",
+    }
+    finished: Dict[str, float] = {}
+    errors: Dict[str, BaseException] = {}
+    winner, out = None, None
+    pending = set(tasks)
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            # Prefer the template when both finish together, it's the vetted SQL.
+            for task in sorted(done, key=lambda t: tasks[t] != "template"):
+                name = tasks[task]
+                finished[name] = time.perf_counter() - start
+                if task.exception() is not None:
+                    errors[name] = task.exception()
+                elif task.result() is not None and winner is None:
+                    winner, out = name, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    for name, error in errors.items():
+        print(f"The speculative {name} path failed: {error!r}")
+    SPECULATION.inc(winner or "none")
+    event(f"speculation_{winner or 'none'}_won")
+    if winner is None:
+        if "llm" in errors:
+            raise errors["llm"]
+        return None
+    saved = finished["template"] if winner == "llm" and "template" in finished else 0.0
+    SPECULATION_SAVED_SECONDS.observe(saved, winner)
+    set_path(f"speculative_{winner}")
+    return out
+
+
+@app.post("/query")
+@traced("query")
+async def query_with_language(
+    query: QueryRequest,
+    background_tasks: BackgroundTasks,
+    accept: Optional[str] = Header(None),
+):
+    # Continuing a paged result, the token carries the SQL so there's nothing to generate.
+    # The SQL passed the cost guard for the first page, its timeout still applies.
+    if query.page_token is not None:
+        set_path("page")
+        try:
+            with span("execute"), statement_timeout(COST_GUARD.statement_timeout_ms):
+                page = await PAGINATOR.next_page(query.page_token, query.limit)
+        except InvalidPageToken as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return page_response(page, accept)
+
+    # Stream the rows through a server side cursor when asked for NDJSON, Arrow IPC or
+    # Parquet instead of building the whole result in memory. The execute stage of a
+    # streamed response only covers the first batch, the rest is sent afterwards.
+    fmt = columnar_format(accept)
+    if query.limit is not None:
+        execute = functools.partial(run_page, limit=query.limit, accept=accept)
+    elif fmt is not None:
+        execute = functools.partial(columnar_sql, fmt=fmt, itersize=query.itersize)
+    elif wants_ndjson(accept):
+        execute = functools.partial(stream_sql, itersize=query.itersize)
+    else:
+        execute = run_sql
+
+    # Determine if we should use function calling. The schema context is only needed
+    # if we fall back to the LLM but it's independent of the embedding so fetch both
+    # at the same time, it's almost always served from memory.
+    embedding, schema_context = await asyncio.gather(
+        timed("embedding", get_embedding(query.query)),
+        timed("schema", get_schema_context()),
+    )
+
+    # If somebody already asked (almost) the same question reuse the SQL we generated
+    # for them and skip the LLM entirely.
+    pool = await get_async_pool()
+    if query.use_answer_cache:
+        with span("answer_cache"):
+            cached = await ANSWER_CACHE.lookup(
+                pool, query.query, embedding, SCHEMA_CACHE.version
+            )
+        if cached is not None:
+            print(f"Reusing the answer to {cached['user_query']!r}")
+            set_path("answer_cache")
+            try:
+                decision = await guard_sql(cached["sql_query"])
+                return await run_guarded(execute, decision)
+            except Exception:
+                print(traceback.format_exc())
+                ANSWER_CACHE.record_failed_reuse()
+                event("answer_cache_failed")
+
+    # Query Table for similar queries
+    with span("vector_search"):
+        similar_sql_queries = await search_templates(pool, embedding, n=5)
+    print(similar_sql_queries)
+    distance = similar_sql_queries[0][-1]
+
+    template = functools.partial(
+        answer_with_template, query, similar_sql_queries, execute
+    )
+    llm = functools.partial(
+        answer_with_llm, query, schema_context, embedding, execute, background_tasks
+    )
+    # Near the threshold it's a coin toss whether a template fits, rather than paying
+    # for the tool call and then the SQL generation back to back run both at once.
+    if (
+        SPECULATIVE_ENABLED
+        and execute is run_sql
+        and SPECULATIVE_MIN_DISTANCE <= distance < SPECULATIVE_MAX_DISTANCE
+    ):
+        return await speculate(template(), llm())
+    if distance < TEMPLATE_MAX_DISTANCE:
+        out = await template()
+        if out is not None:
+            return out
+    else:
+        event("fallback_no_similar_template")
+    return await llm()
+
+
+COLD_START.mark("app")
+
+# Lambda runs the module import in its init phase, before the first request arrives.
+# Mangum runs every invocation on the loop returned by get_event_loop so the pool opened
+# here is the one requests will use.
+if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    steps = prewarm_steps()
+    if steps:
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        loop.run_until_complete(prewarm(steps))
+
+
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,343 @@
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# Print one JSON line per request with the time spent in each stage, for CloudWatch Logs
+# Insights. Every lambda container keeps its own /metrics so the logs are the only view
+# across all of them.
+METRICS_LOG = os.getenv("METRICS_LOG", "true").lower() == "true"
+# Histogram buckets in seconds, from a cached embedding up to a slow gpt-4o call.
+METRICS_BUCKETS = tuple(
+    float(b)
+    for b in os.getenv(
+        "METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30"
+    ).split(",")
+)
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Called with the JSON line of every finished request, e.g. by benchmark_api.py.
+REQUEST_LISTENERS: List[Callable[[Dict[str, Any]], None]] = []
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """A Prometheus counter with labels.
+
+    :param name: The metric name, its samples are exposed as `<name>_total`.
+    :param documentation: The HELP text.
+    :param labelnames: The label names, values are passed to `inc` in this order.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    @property
+    def family(self) -> str:
+        """The name in the HELP and TYPE lines, which has to match the samples'."""
+        return f"{self.name}_total"
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.family}{_labels(self.labelnames, labels)} {value:g}"
+
+
+class Histogram:
+    """A Prometheus histogram with labels and fixed buckets.
+
+    :param name: The metric name.
+    :param documentation: The HELP text.
+    :param labelnames: The label names, values are passed to `observe` in this order.
+    :param buckets: The upper bounds of the buckets, +Inf is added.
+    """
+
+    kind = "histogram"
+
+    @property
+    def family(self) -> str:
+        return self.name
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = METRICS_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (not cumulative) + one for +Inf, sum]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self._values.get(labels)
+        return sum(counts[0]) if counts else 0
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                label_text = _labels(self.labelnames, labels, f'le="{le}"')
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            label_text = _labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {total:g}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Registry:
+    """The metrics served by /metrics."""
+
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.family} {metric.documentation}")
+            lines.append(f"# TYPE {metric.family} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "sqlrag_request_seconds",
+        "Time spent handling a request.",
+        ("endpoint", "path", "status"),
+    )
+)
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "sqlrag_stage_seconds",
+        "Time spent in each stage of a request.",
+        ("endpoint", "stage"),
+    )
+)
+PATHS = REGISTRY.register(
+    Counter(
+        "sqlrag_requests",
+        "Requests by the path they took, e.g. template or llm.",
+        ("endpoint", "path"),
+    )
+)
+EVENTS = REGISTRY.register(
+    Counter(
+        "sqlrag_events",
+        "Things that happened along the way, e.g. an LLM fallback and why.",
+        ("endpoint", "event"),
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Histogram(
+        "sqlrag_prompt_tokens",
+        "Prompt tokens of each LLM call, by whether the schema was pruned.",
+        ("endpoint", "schema"),
+        buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+    )
+)
+SPECULATION = REGISTRY.register(
+    Counter(
+        "sqlrag_speculation",
+        "Speculative requests by the path that won, none if both failed.",
+        ("winner",),
+    )
+)
+SPECULATION_SAVED_SECONDS = REGISTRY.register(
+    Histogram(
+        "sqlrag_speculation_saved_seconds",
+        "Latency saved by speculating compared to trying the template first, a lower bound.",
+        ("winner",),
+    )
+)
+
+
+class RequestTrace:
+    """The stages of one request.
+
+    Stages are timed with `span`, the path is whatever the request ended up doing, e.g.
+    "template" or "llm". `finish` records everything in the histograms and counters and
+    logs a JSON line.
+
+    :param endpoint: The name of the endpoint, e.g. "query".
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.path = "default"
+        self.status = "ok"
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.events: List[str] = []
+        # Numbers about the request other than time, e.g. the LLM's prompt tokens.
+        self.values: Dict[str, float] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            # A stage that runs twice, e.g. executing a query and its retry, is summed.
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            STAGE_SECONDS.observe(seconds, self.endpoint, stage)
+
+    def event(self, name: str):
+        self.events.append(name)
+        EVENTS.inc(self.endpoint, name)
+
+    def record(self, name: str, value: float):
+        # Summed like stages, e.g. the prompt tokens of a generation and its retry.
+        self.values[name] = self.values.get(name, 0) + value
+
+    def finish(self):
+        seconds = time.perf_counter() - self.start
+        REQUEST_SECONDS.observe(seconds, self.endpoint, self.path, self.status)
+        PATHS.inc(self.endpoint, self.path)
+        record = self.to_dict(seconds)
+        if METRICS_LOG:
+            print(json.dumps(record))
+        for listener in REQUEST_LISTENERS:
+            listener(record)
+
+    def to_dict(self, seconds: Optional[float] = None) -> Dict[str, Any]:
+        if seconds is None:
+            seconds = time.perf_counter() - self.start
+        return {
+            "metric": "request",
+            "endpoint": self.endpoint,
+            "path": self.path,
+            "status": self.status,
+            "total_ms": round(seconds * 1000, 2),
+            "stages_ms": {k: round(v * 1000, 2) for k, v in self.stages.items()},
+            "events": self.events,
+            "values": self.values,
+        }
+
+
+_TRACE: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar(
+    "request_trace", default=None
+)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _TRACE.get()
+
+
+def traced(endpoint: str):
+    """Trace every call of an async endpoint, the trace is found with `span` etc.
+
+    Errors are recorded with status "error" and re-raised.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            trace = RequestTrace(endpoint)
+            token = _TRACE.set(trace)
+            try:
+                return await fn(*args, **kwargs)
+            except BaseException:
+                trace.status = "error"
+                raise
+            finally:
+                _TRACE.reset(token)
+                trace.finish()
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a stage of the current request, does nothing outside of a traced one."""
+    trace = _TRACE.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+async def timed(stage: str, awaitable: Awaitable) -> Any:
+    """Await something as a stage, for stages run concurrently with asyncio.gather."""
+    with span(stage):
+        return await awaitable
+
+
+def set_path(path: str):
+    """Record the path the current request took, e.g. "template" or "llm"."""
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.path = path
+
+
+def record(name: str, value: float):
+    """Add a number to the current request's record, e.g. prompt tokens."""
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.record(name, value)
+
+
+def event(name: str):
+    """Count something that happened in the current request."""
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.event(name)
@@ -0,0 +1,527 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+from fastapi.responses import Response
+
+from columnar import columnar_format, rows_to_columnar
+from db import get_async_pool, to_row
+from result_cache import normalize_sql
+from streaming import NDJSON_MEDIA_TYPE, encode_ndjson, wants_ndjson
+
+# Tokens are signed so a client can't swap in its own SQL. Every lambda container has to
+# share the key to accept the others' tokens so it must be set there, api_stack sets it
+# from a generated secret. Run locally a random key is fine.
+PAGE_TOKEN_SECRET = os.getenv("PAGE_TOKEN_SECRET")
+if not PAGE_TOKEN_SECRET:
+    if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+        raise RuntimeError("PAGE_TOKEN_SECRET has to be set when running on lambda.")
+    PAGE_TOKEN_SECRET = secrets.token_hex(32)
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "10000"))
+# Queries without a usable ORDER BY keep their cursor open between pages. Each one holds
+# a pooled connection so only allow a few and close them quickly.
+PAGE_MAX_SESSIONS = int(os.getenv("PAGE_MAX_SESSIONS", "1"))
+PAGE_SESSION_TTL_SECONDS = float(os.getenv("PAGE_SESSION_TTL_SECONDS", "60"))
+NEXT_PAGE_HEADER = "X-Next-Page-Token"
+
+# Column types which can't be compared with < and > so are never used as tie breakers.
+# Arrays (names starting with _) are skipped too.
+_UNORDERED_TYPES = {"json", "jsonb", "vector", "xml", "point", "polygon", "bytea"}
+_SQL_PARTS = re.compile(
+    r"""('(?:[^']|'')*')|("(?:[^"]|"")*")|([(),])|(\b(?:order\s+by|limit|offset|fetch|for)\b)""",
+    re.IGNORECASE,
+)
+_ORDER_ITEM = re.compile(
+    r"""^(?P<expr>.+?)(?:\s+(?P<direction>asc|desc))?(?:\s+(?P<nulls>nulls\s+(?:first|last)))?$""",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+class InvalidPageToken(ValueError):
+    """Raised for page tokens that are malformed, tampered with, or for another query."""
+
+
+def encode_page_token(state: Dict[str, Any]) -> str:
+    """Sign and encode the state needed to fetch the next page."""
+    payload = base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+    signature = hmac.new(
+        PAGE_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{payload}.{signature}"
+
+
+def decode_page_token(token: str) -> Dict[str, Any]:
+    """Check the signature of a page token and decode it."""
+    payload, _, signature = token.partition(".")
+    expected = hmac.new(
+        PAGE_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        raise InvalidPageToken("Invalid page token.")
+    try:
+        return json.loads(base64.urlsafe_b64decode(payload.encode()))
+    except ValueError:
+        raise InvalidPageToken("Invalid page token.")
+
+
+def order_by_items(sql: str) -> Optional[List[Tuple[str, bool, bool]]]:
+    """Get the top level ORDER BY of a query as (expression, descending, has_nulls).
+
+    ORDER BYs inside sub queries, window definitions and aggregates are ignored.
+    """
+    depth = 0
+    start = end = None
+    items = []
+    for match in _SQL_PARTS.finditer(sql):
+        quoted, punctuation, keyword = (
+            match.group(1) or match.group(2),
+            match.group(3),
+            match.group(4),
+        )
+        if quoted:
+            continue
+        if punctuation == "(":
+            depth += 1
+        elif punctuation == ")":
+            depth -= 1
+        elif depth > 0:
+            continue
+        elif keyword and keyword.lower().startswith("order"):
+            start, end, items = match.end(), None, []
+        elif keyword and start is not None and end is None:
+            end = match.start()
+        elif punctuation == "," and start is not None and end is None:
+            items.append((start, match.start()))
+            start = match.end()
+    if start is None:
+        return None
+    items.append((start, len(sql) if end is None else end))
+    out = []
+    for item_start, item_end in items:
+        parts = _ORDER_ITEM.match(sql[item_start:item_end].strip())
+        if parts is None:
+            return None
+        out.append(
+            (
+                parts.group("expr").strip(),
+                (parts.group("direction") or "").lower() == "desc",
+                parts.group("nulls") is not None,
+            )
+        )
+    return out
+
+
+def _resolve_column(expression: str, names: List[str]) -> Optional[int]:
+    """Find the output column an ORDER BY expression refers to."""
+    if expression.isdigit():
+        position = int(expression) - 1
+        return position if 0 <= position < len(names) else None
+    # Drop a table qualifier, e.g. all_companies."Annual Revenue".
+    match = re.match(r'^(?:(?:"(?:[^"]|"")*"|\w+)\.)?("(?:[^"]|"")*"|\w+)$', expression)
+    if match is None:
+        return None
+    name = match.group(1)
+    name = name[1:-1].replace('""', '"') if name.startswith('"') else name.lower()
+    return names.index(name) if name in names else None
+
+
+def keyset_keys(
+    sql: str, attributes: Sequence[Any]
+) -> Optional[List[Tuple[int, bool]]]:
+    """Get the (column index, descending) keys used to page through a query.
+
+    The query's own ORDER BY comes first, then every other comparable output column is
+    appended as a tie breaker so the order is total. Returns None if the query has no
+    ORDER BY made of output columns, and the query is paged with a cursor instead.
+    """
+    names = [a.name for a in attributes]
+    items = order_by_items(sql)
+    if not items or len(set(names)) != len(names):
+        return None
+    keys = []
+    for expression, descending, has_nulls in items:
+        index = _resolve_column(expression, names)
+        # NULLS FIRST/LAST would need its own comparison rules.
+        if index is None or has_nulls:
+            return None
+        if index not in [k for k, _ in keys]:
+            keys.append((index, descending))
+    for index, attribute in enumerate(attributes):
+        if index not in [k for k, _ in keys]:
+            if (
+                attribute.type.name in _UNORDERED_TYPES
+                or attribute.type.name.startswith("_")
+            ):
+                continue
+            keys.append((index, False))
+    return keys
+
+
+def _quote(name: str) -> str:
+    # Always quoted, an output column can be called "user" or "order".
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _cast(param: int, attribute: Any) -> str:
+    return (
+        f"CAST(${param}::text AS {_quote(attribute.type.schema)}."
+        f"{_quote(attribute.type.name)})"
+    )
+
+
+def keyset_query(
+    sql: str,
+    attributes: Sequence[Any],
+    keys: List[Tuple[int, bool]],
+    after: Optional[List[Optional[str]]],
+    n_args: int = 0,
+) -> Tuple[str, List[Optional[str]]]:
+    """Wrap a query so it returns the rows from `after` onwards in key order.
+
+    Rows equal to `after` are included, the caller skips the ones already returned
+    with the OFFSET so duplicate rows straddling a page boundary aren't lost. postgres
+    sorts NULLs last ascending and first descending, the comparisons follow the same
+    rules. Key values travel as text and are cast back to the column type. The last
+    column of the result holds the keys of each row as text for the next token.
+
+    :param after: The keys of the last row of the previous page, in key order.
+    :param n_args: The number of $n parameters the query already uses.
+    :return: The SQL, with the LIMIT and OFFSET as the last parameters, and its
+        parameters.
+    """
+    columns = [_quote(a.name) for a in attributes]
+    params: List[Optional[str]] = []
+
+    def equal(index: int, value: Optional[str]) -> str:
+        if value is None:
+            return f"{columns[index]} IS NULL"
+        params.append(value)
+        return f"{columns[index]} = {_cast(n_args + len(params), attributes[index])}"
+
+    where = ""
+    if after is not None:
+        alternatives = []
+        for i, (index, descending) in enumerate(keys):
+            column, value = columns[index], after[i]
+            # Nothing sorts after a NULL ascending.
+            if value is None and not descending:
+                continue
+            terms = [equal(k, v) for (k, _), v in zip(keys[:i], after)]
+            if value is None:
+                terms.append(f"{column} IS NOT NULL")
+            else:
+                params.append(value)
+                op = "<" if descending else ">"
+                term = f"{column} {op} {_cast(n_args + len(params), attributes[index])}"
+                terms.append(term if descending else f"({term} OR {column} IS NULL)")
+            alternatives.append("(" + " AND ".join(terms) + ")")
+        alternatives.append(
+            "(" + " AND ".join(equal(k, v) for (k, _), v in zip(keys, after)) + ")"
+        )
+        where = "WHERE " + " OR ".join(alternatives)
+    order = ", ".join(
+        f"{columns[index]} {'DESC' if descending else 'ASC'}"
+        for index, descending in keys
+    )
+    page_keys = ", ".join(f"{columns[index]}::text" for index, _ in keys)
+    page_sql = (
+        f"SELECT page.*, ARRAY[{page_keys}] AS page_keys FROM ({sql}) AS page "
+        f"{where} ORDER BY {order} "
+        f"LIMIT ${n_args + len(params) + 1} OFFSET ${n_args + len(params) + 2}"
+    )
+    return page_sql, params
+
+
+class Page:
+    """One page of a query result.
+
+    :param rows: The rows of this page.
+    :param attributes: The column names and types.
+    :param next_page_token: The token to fetch the next page or None if this is the last.
+    """
+
+    def __init__(
+        self,
+        rows: List[tuple],
+        attributes: Sequence[Any],
+        next_page_token: Optional[str],
+    ):
+        self.rows = rows
+        self.attributes = attributes
+        self.next_page_token = next_page_token
+
+
+class CursorSession:
+    """A server side cursor kept open between page requests on its own connection."""
+
+    def __init__(self, conn: asyncpg.Connection, transaction, cursor, attributes):
+        self.id = secrets.token_hex(8)
+        self.conn = conn
+        self.transaction = transaction
+        self.cursor = cursor
+        self.attributes = attributes
+        self.offset = 0
+        self.lookahead: List[Any] = []
+        self.expires_at = time.monotonic() + PAGE_SESSION_TTL_SECONDS
+        self.lock = asyncio.Lock()
+
+    async def fetch(self, limit: int) -> Tuple[List[Any], bool]:
+        """Get the next `limit` rows and whether there are more."""
+        rows = self.lookahead + await self.cursor.fetch(limit + 1 - len(self.lookahead))
+        self.lookahead = rows[limit:]
+        self.offset += len(rows[:limit])
+        self.expires_at = time.monotonic() + PAGE_SESSION_TTL_SECONDS
+        return rows[:limit], bool(self.lookahead)
+
+
+class Paginator:
+    """Fetches query results one page at a time.
+
+    Queries with an ORDER BY on their output columns are paged with keyset pagination,
+    the token carries the last row's keys. The user's query is wrapped as a subquery and
+    run again in full for every page, only the rows past the keys are returned.
+    Anything else keeps its server side cursor open between requests. When the session
+    has expired, lives in another container, or there are too many open, the page is
+    fetched with OFFSET instead.
+
+    :param max_sessions: The number of cursor sessions which can be open at once.
+    :param session_ttl_seconds: Close sessions which haven't been used for this long.
+    :param max_limit: The largest page size.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = PAGE_MAX_SESSIONS,
+        session_ttl_seconds: float = PAGE_SESSION_TTL_SECONDS,
+        max_limit: int = PAGE_MAX_LIMIT,
+    ):
+        self.max_sessions = max_sessions
+        self.session_ttl_seconds = session_ttl_seconds
+        self.max_limit = max_limit
+        self.sessions: Dict[str, CursorSession] = {}
+        self.counters = {"keyset": 0, "cursor": 0, "offset": 0, "expired_sessions": 0}
+
+    async def _close_session(self, session: CursorSession):
+        self.sessions.pop(session.id, None)
+        pool = await get_async_pool()
+        try:
+            if session.conn.is_in_transaction():
+                await session.transaction.rollback()
+        finally:
+            await pool.release(session.conn)
+
+    async def close_expired(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if session.expires_at < now and not session.lock.locked():
+                self.counters["expired_sessions"] += 1
+                await self._close_session(session)
+
+    async def _open_session(
+        self, sql: str, args: Sequence[Any]
+    ) -> Optional[CursorSession]:
+        if len(self.sessions) >= self.max_sessions:
+            return None
+        pool = await get_async_pool()
+        conn = await pool.acquire()
+        transaction = conn.transaction()
+        try:
+            await transaction.start()
+            statement = await conn.prepare(sql)
+            cursor = await statement.cursor(*args)
+        except BaseException:
+            try:
+                if conn.is_in_transaction():
+                    await transaction.rollback()
+            finally:
+                await pool.release(conn)
+            raise
+        session = CursorSession(conn, transaction, cursor, statement.get_attributes())
+        self.sessions[session.id] = session
+        return session
+
+    async def _fetch_session(
+        self, session: CursorSession, sql: str, args: Sequence[Any], limit: int
+    ):
+        async with session.lock:
+            rows, more = await session.fetch(limit)
+        self.counters["cursor"] += 1
+        token = None
+        if more:
+            token = encode_page_token(
+                {
+                    "sql": sql,
+                    "args": list(args),
+                    "limit": limit,
+                    "session": session.id,
+                    "offset": session.offset,
+                }
+            )
+        else:
+            await self._close_session(session)
+        return Page([to_row(r) for r in rows], session.attributes, token)
+
+    async def _fetch_offset(
+        self, sql: str, args: Sequence[Any], limit: int, offset: int
+    ) -> Page:
+        pool = await get_async_pool()
+        async with pool.acquire() as conn:
+            statement = await conn.prepare(
+                f"SELECT * FROM ({sql}) AS page "
+                f"OFFSET ${len(args) + 1} LIMIT ${len(args) + 2}"
+            )
+            rows = await statement.fetch(*args, offset, limit + 1)
+            attributes = statement.get_attributes()
+        self.counters["offset"] += 1
+        token = None
+        if len(rows) > limit:
+            token = encode_page_token(
+                {
+                    "sql": sql,
+                    "args": list(args),
+                    "limit": limit,
+                    "session": None,
+                    "offset": offset + limit,
+                }
+            )
+        return Page([to_row(r) for r in rows[:limit]], attributes, token)
+
+    async def _fetch_keyset(
+        self,
+        conn: asyncpg.Connection,
+        sql: str,
+        args: Sequence[Any],
+        limit: int,
+        attributes: Sequence[Any],
+        keys: List[Tuple[int, bool]],
+        after: Optional[List[Optional[str]]],
+        skip: int = 0,
+    ) -> Page:
+        page_sql, params = keyset_query(sql, attributes, keys, after, len(args))
+        rows = await conn.fetch(page_sql, *args, *params, limit + 1, skip)
+        self.counters["keyset"] += 1
+        token = None
+        if len(rows) > limit:
+            last = list(rows[limit - 1][-1])
+            # Count the rows equal to the last one, they're skipped on the next page.
+            ties = 0
+            for row in reversed(rows[:limit]):
+                if list(row[-1]) != last:
+                    break
+                ties += 1
+            if ties == limit and last == after:
+                ties += skip
+            token = encode_page_token(
+                {
+                    "sql": sql,
+                    "args": list(args),
+                    "limit": limit,
+                    "keys": keys,
+                    "after": last,
+                    "skip": ties,
+                }
+            )
+        return Page([to_row(r)[:-1] for r in rows[:limit]], attributes, token)
+
+    async def first_page(self, sql: str, limit: int, args: Sequence[Any] = ()) -> Page:
+        """Run a query and get its first page.
+
+        The query is prepared before anything else so errors are raised to the caller.
+
+        :param sql: The SQL statement to run.
+        :param limit: The number of rows per page.
+        :param args: The values of the statement's $n parameters.
+        """
+        await self.close_expired()
+        limit = max(1, min(limit, self.max_limit))
+        sql = normalize_sql(sql)
+        pool = await get_async_pool()
+        async with pool.acquire() as conn:
+            attributes = (await conn.prepare(sql)).get_attributes()
+            keys = keyset_keys(sql, attributes)
+            if keys is not None:
+                return await self._fetch_keyset(
+                    conn, sql, args, limit, attributes, keys, None
+                )
+        session = await self._open_session(sql, args)
+        if session is None:
+            return await self._fetch_offset(sql, args, limit, 0)
+        return await self._fetch_session(session, sql, args, limit)
+
+    async def next_page(self, token: str, limit: Optional[int] = None) -> Page:
+        """Get the page after the one a token was issued with.
+
+        :param token: The next_page_token of the previous page.
+        :param limit: Change the page size, defaults to the previous page size.
+        """
+        await self.close_expired()
+        state = decode_page_token(token)
+        sql, args = state["sql"], state.get("args", [])
+        limit = max(1, min(limit or state["limit"], self.max_limit))
+        if "keys" in state:
+            keys = [tuple(k) for k in state["keys"]]
+            pool = await get_async_pool()
+            async with pool.acquire() as conn:
+                attributes = (await conn.prepare(sql)).get_attributes()
+                if any(index >= len(attributes) for index, _ in keys):
+                    raise InvalidPageToken("The query's columns changed.")
+                return await self._fetch_keyset(
+                    conn,
+                    sql,
+                    args,
+                    limit,
+                    attributes,
+                    keys,
+                    state["after"],
+                    state["skip"],
+                )
+        session = self.sessions.get(state["session"] or "")
+        if session is not None and session.offset == state["offset"]:
+            return await self._fetch_session(session, sql, args, limit)
+        return await self._fetch_offset(sql, args, limit, state["offset"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "open_sessions": len(self.sessions)}
+
+
+PAGINATOR = Paginator()
+
+
+def page_response(page: Page, accept: Optional[str] = None):
+    """Render a page in the format asked for by the Accept header.
+
+    JSON pages carry the column names and token in the body, NDJSON, Arrow and Parquet
+    pages carry the token in the X-Next-Page-Token header.
+    """
+    headers = {}
+    if page.next_page_token is not None:
+        headers[NEXT_PAGE_HEADER] = page.next_page_token
+    fmt = columnar_format(accept)
+    if fmt is not None:
+        response = rows_to_columnar(
+            page.rows, {a.name: a.type.name for a in page.attributes}, fmt
+        )
+        response.headers.update(headers)
+        return response
+    if wants_ndjson(accept):
+        return Response(
+            encode_ndjson(page.rows), media_type=NDJSON_MEDIA_TYPE, headers=headers
+        )
+    return {
+        "columns": [a.name for a in page.attributes],
+        "rows": page.rows,
+        "next_page_token": page.next_page_token,
+    }
+
+
+async def run_page(sql: str, *args: Any, limit: int, accept: Optional[str] = None):
+    """Run a SQL statement and render its first page."""
+    return page_response(await PAGINATOR.first_page(sql, limit, args), accept)
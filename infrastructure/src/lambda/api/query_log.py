@@ -0,0 +1,240 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import asyncpg
+
+from db import get_async_pool
+
+# Records are written in batches once this many are buffered or the oldest has waited
+# QUERY_LOG_FLUSH_SECONDS, whichever comes first.
+QUERY_LOG_BATCH_SIZE = int(os.getenv("QUERY_LOG_BATCH_SIZE", "50"))
+QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "1"))
+# What to do when the buffer is full because postgres can't keep up: "drop_oldest",
+# "drop_newest" or "block" until a flush makes room.
+QUERY_LOG_MAX_BUFFER = int(os.getenv("QUERY_LOG_MAX_BUFFER", "1000"))
+QUERY_LOG_OVERFLOW = os.getenv("QUERY_LOG_OVERFLOW", "drop_oldest")
+# A lambda container is frozen as soon as the invocation returns, so buffered records
+# would only be written in a later invocation and are lost if the container is reaped.
+# Writing behind there needs a lambda extension or a queue (SQS/Firehose), until then
+# every record is inserted before the invocation returns like it always was.
+QUERY_LOG_WRITE_BEHIND = (
+    os.getenv(
+        "QUERY_LOG_WRITE_BEHIND",
+        "false" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "true",
+    ).lower()
+    == "true"
+)
+# Write the buffer after the response has been sent. Under uvicorn this is free, behind
+# Mangum the invocation only returns once it's done.
+QUERY_LOG_FLUSH_AT_RESPONSE_END = (
+    os.getenv("QUERY_LOG_FLUSH_AT_RESPONSE_END", "false").lower() == "true"
+)
+
+USER_QUERY_COLUMNS = (
+    "user_query",
+    "sql_query",
+    "conversation_history",
+    "embedding",
+    "succeeded",
+    "schema_version",
+    "guard_action",
+)
+
+
+class QueryLogger:
+    """Write behind logger for the user_queries table.
+
+    `log` only appends to an in memory buffer, a background task writes the buffer
+    with COPY in batches of up to `batch_size` records. The buffer is bounded, when it's
+    full the `overflow` policy either drops records or makes the caller wait. Records
+    that fail to write are put back once and dropped if they fail again.
+
+    With `write_behind` off, which is the default on lambda, `log` inserts the record
+    straight away instead. `flush` is also called on SIGTERM, which lambda sends before
+    shutting a container down when an extension is registered.
+
+    :param batch_size: Flush once this many records are buffered.
+    :param flush_seconds: Flush records which have been buffered this long.
+    :param max_buffer: The most records held in memory.
+    :param overflow: "drop_oldest", "drop_newest" or "block".
+    :param columns: The user_queries columns of each record.
+    :param write_behind: Buffer records, otherwise each one is inserted in `log`.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = QUERY_LOG_BATCH_SIZE,
+        flush_seconds: float = QUERY_LOG_FLUSH_SECONDS,
+        max_buffer: int = QUERY_LOG_MAX_BUFFER,
+        overflow: str = QUERY_LOG_OVERFLOW,
+        columns: tuple = USER_QUERY_COLUMNS,
+        write_behind: bool = QUERY_LOG_WRITE_BEHIND,
+    ):
+        if overflow not in ("drop_oldest", "drop_newest", "block"):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self.columns = columns
+        self.write_behind = write_behind
+        # (record, attempts, logged_at)
+        self._buffer: Deque[Any] = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Condition] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._loop = None
+        self.counters = {
+            "logged": 0,
+            "written": 0,
+            "flushes": 0,
+            "dropped": 0,
+            "failed_flushes": 0,
+            "blocked": 0,
+        }
+
+    def _ensure_started(self):
+        """Start the flush task on the running loop, once per event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._wait_time())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._buffer:
+                await self.flush()
+
+    def _wait_time(self) -> float:
+        if not self._buffer:
+            return self.flush_seconds
+        oldest = self._buffer[0][2]
+        return max(0.0, oldest + self.flush_seconds - time.monotonic())
+
+    async def log(self, **record: Any):
+        """Buffer a record for user_queries, this doesn't touch the database.
+
+        Without `write_behind` the record is inserted before this returns.
+
+        :param record: A value for each of `columns`.
+        """
+        if not self.write_behind:
+            await self._insert(tuple(record.get(c) for c in self.columns))
+            return
+        self._ensure_started()
+        if len(self._buffer) >= self.max_buffer:
+            if self.overflow == "drop_newest":
+                self.counters["dropped"] += 1
+                return
+            if self.overflow == "drop_oldest":
+                self._buffer.popleft()
+                self.counters["dropped"] += 1
+            else:
+                self.counters["blocked"] += 1
+                self._wakeup.set()
+                async with self._space:
+                    await self._space.wait_for(
+                        lambda: len(self._buffer) < self.max_buffer
+                    )
+        self._buffer.append(
+            (tuple(record.get(c) for c in self.columns), 0, time.monotonic())
+        )
+        self.counters["logged"] += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _insert(self, record: tuple):
+        self.counters["logged"] += 1
+        placeholders = ", ".join(f"${i + 1}" for i in range(len(self.columns)))
+        try:
+            pool = await get_async_pool()
+            await pool.execute(
+                f"INSERT INTO user_queries ({', '.join(self.columns)}) "
+                f"VALUES ({placeholders})",
+                *record,
+            )
+            self.counters["written"] += 1
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+            print(traceback.format_exc())
+            self.counters["dropped"] += 1
+
+    async def flush(self):
+        """Write everything buffered, one COPY per batch."""
+        if self._flush_lock is None:
+            self._ensure_started()
+        async with self._flush_lock:
+            while self._buffer:
+                batch = [
+                    self._buffer.popleft()
+                    for _ in range(min(self.batch_size, len(self._buffer)))
+                ]
+                try:
+                    pool = await get_async_pool()
+                    await pool.copy_records_to_table(
+                        "user_queries",
+                        records=[record for record, _, _ in batch],
+                        columns=list(self.columns),
+                    )
+                    self.counters["written"] += len(batch)
+                    self.counters["flushes"] += 1
+                except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+                    print(traceback.format_exc())
+                    self.counters["failed_flushes"] += 1
+                    retry = [(r, n + 1, t) for r, n, t in batch if n == 0]
+                    self.counters["dropped"] += len(batch) - len(retry)
+                    room = self.max_buffer - len(self._buffer)
+                    self.counters["dropped"] += max(0, len(retry) - room)
+                    self._buffer.extendleft(reversed(retry[:room]))
+                    break
+                finally:
+                    async with self._space:
+                        self._space.notify_all()
+
+    def flush_blocking(self):
+        """Flush from outside the event loop, e.g. from a signal handler."""
+        if not self._buffer or self._loop is None or self._loop.is_closed():
+            return
+        if self._loop.is_running():
+            self._loop.create_task(self.flush())
+        else:
+            self._loop.run_until_complete(self.flush())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "buffered": len(self._buffer),
+            "max_buffer": self.max_buffer,
+            "overflow": self.overflow,
+            "write_behind": self.write_behind,
+        }
+
+
+QUERY_LOGGER = QueryLogger()
+
+
+def _flush_on_sigterm(signum, frame):
+    QUERY_LOGGER.flush_blocking()
+    sys.exit(0)
+
+
+# Lambda only delivers SIGTERM before shutting down a container when an extension is
+# registered, so this is a backstop for QUERY_LOG_FLUSH_AT_RESPONSE_END. uvicorn installs
+# its own handler and flushes through the shutdown event instead.
+if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    signal.signal(signal.SIGTERM, _flush_on_sigterm)
@@ -0,0 +1,235 @@
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import asyncpg
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "300"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024**2)))
+# Don't let one huge result push everything else out of the cache.
+RESULT_CACHE_MAX_ENTRY_BYTES = int(
+    os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(8 * 1024**2))
+)
+# How often to reload the table versions bumped by setup_db.py when it reloads a table.
+RESULT_CACHE_VERSION_CHECK_SECONDS = float(
+    os.getenv("RESULT_CACHE_VERSION_CHECK_SECONDS", "5")
+)
+
+# Quoted strings and identifiers are kept as is, comments are dropped and whitespace
+# is collapsed so formatting differences don't produce different cache keys.
+_SQL_TOKENS = re.compile(
+    r"""('(?:[^']|'')*')|("(?:[^"]|"")*")|(--[^\n]*|/\*.*?\*/)|(\s+)""", re.DOTALL
+)
+_CACHEABLE = re.compile(r"^\s*(select|with|values|table)\b", re.IGNORECASE)
+# Anything called like a function, e.g. `random(` or `"my_func" (`.
+_CALLS = re.compile(r"""("(?:[^"]|"")+"|[a-z_][\w$]*)\s*\(""", re.IGNORECASE)
+
+VOLATILE_FUNCTIONS_QUERY = "SELECT DISTINCT proname FROM pg_proc WHERE provolatile = 'v'"
+
+
+def normalize_sql(sql: str) -> str:
+    """Normalize SQL text for use as a cache key."""
+
+    def replace(match: re.Match) -> str:
+        if match.group(1) or match.group(2):
+            return match.group(0)
+        return " "
+
+    # The second pass merges the whitespace left around removed comments.
+    sql = _SQL_TOKENS.sub(replace, _SQL_TOKENS.sub(replace, sql))
+    return sql.strip().rstrip(";").strip()
+
+
+def cache_key(sql: str, args: Sequence[Any] = ()) -> str:
+    """Build the cache key of a SQL query and the values of its parameters."""
+    key = normalize_sql(sql)
+    return f"{key}\0{json.dumps(list(args), default=str)}" if args else key
+
+
+def called_functions(normalized_sql: str) -> Set[str]:
+    """Get the (lower cased, unless quoted) names of everything called in the SQL."""
+    names = set()
+    for name in _CALLS.findall(re.sub(r"'(?:[^']|'')*'", "''", normalized_sql)):
+        if name.startswith('"'):
+            names.add(name[1:-1].replace('""', '"'))
+        else:
+            names.add(name.lower())
+    return names
+
+
+def referenced_tables(normalized_sql: str, tables: List[str]) -> List[str]:
+    """Get the tables out of `tables` that appear as identifiers in the SQL."""
+    found = []
+    for table in tables:
+        quoted = '"' + table.replace('"', '""') + '"'
+        if quoted in normalized_sql or re.search(
+            rf"(?<![\w\"]){re.escape(table)}(?![\w\"])", normalized_sql, re.IGNORECASE
+        ):
+            found.append(table)
+    return found
+
+
+class ResultCache:
+    """Cache query results keyed on the normalized SQL text.
+
+    Entries expire after `ttl_seconds` and the least recently used entries are evicted
+    once the cache holds more than `max_bytes` of (JSON encoded) results. setup_db.py
+    bumps a counter in the `table_versions` table whenever it reloads a table. Those are
+    polled every `version_check_seconds` and every entry reading from a table whose
+    version changed is dropped.
+
+    Only statements that read are cached. Callers run them in a READ ONLY transaction
+    and only `put` the result when that succeeded, which rules out a `WITH` holding a
+    DELETE or a function that writes. Statements calling a volatile function, e.g.
+    `random()` or `clock_timestamp()`, are never cached. The volatile functions are
+    loaded from pg_proc once per container.
+
+    :param enabled: Turn the cache off without removing it from the pipeline.
+    :param ttl_seconds: How long a result can be served from the cache.
+    :param max_bytes: The total size of cached results.
+    :param max_entry_bytes: Results larger than this are not cached.
+    :param version_check_seconds: How often to reload the table versions.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESULT_CACHE_ENABLED,
+        ttl_seconds: float = RESULT_CACHE_TTL_SECONDS,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        max_entry_bytes: int = RESULT_CACHE_MAX_ENTRY_BYTES,
+        version_check_seconds: float = RESULT_CACHE_VERSION_CHECK_SECONDS,
+    ):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.version_check_seconds = version_check_seconds
+        self.bytes = 0
+        self.table_versions: Dict[str, int] = {}
+        self.versions_checked_at = 0.0
+        self.use_versions = True
+        self.volatile_functions: Optional[Set[str]] = None
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "too_large": 0,
+        }
+        # key -> (rows, size, stored_at)
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+
+    async def refresh_versions(self, conn: asyncpg.Connection):
+        """Reload the table versions if they haven't been checked recently."""
+        if not self.use_versions:
+            return
+        now = time.monotonic()
+        if now - self.versions_checked_at < self.version_check_seconds:
+            return
+        self.versions_checked_at = now
+        try:
+            rows = await conn.fetch("SELECT table_name, version FROM table_versions")
+        except asyncpg.UndefinedTableError:
+            print("table_versions doesn't exist, results only expire by TTL.")
+            self.use_versions = False
+            return
+        versions = {r["table_name"]: r["version"] for r in rows}
+        for table, version in versions.items():
+            if self.table_versions.get(table) != version:
+                self.invalidate_table(table)
+        self.table_versions = versions
+
+    async def load_volatile_functions(self, conn: asyncpg.Connection):
+        """Load the names of the volatile functions if they haven't been loaded yet."""
+        if self.volatile_functions is None:
+            rows = await conn.fetch(VOLATILE_FUNCTIONS_QUERY)
+            self.volatile_functions = {r["proname"] for r in rows}
+
+    def cacheable(self, sql: str) -> bool:
+        """Whether the result of a SQL query can be cached, if it also runs read only.
+
+        Needs `load_volatile_functions` first, nothing is cacheable until then.
+        """
+        if not self.enabled or self.volatile_functions is None:
+            return False
+        if not _CACHEABLE.match(sql):
+            return False
+        return not called_functions(normalize_sql(sql)) & self.volatile_functions
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    async def get(
+        self, conn: asyncpg.Connection, sql: str, args: Sequence[Any] = ()
+    ) -> Optional[List[tuple]]:
+        """Get the cached result of a SQL query if it is still valid.
+
+        :param conn: An asyncpg connection or pool used to check the table versions.
+        :param sql: The SQL text that would be executed.
+        :param args: The values of its $n parameters.
+        """
+        if not self.enabled or not _CACHEABLE.match(sql):
+            return None
+        await self.load_volatile_functions(conn)
+        if not self.cacheable(sql):
+            return None
+        await self.refresh_versions(conn)
+        key = cache_key(sql, args)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        rows, _, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self._remove(key)
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return rows
+
+    def put(self, sql: str, rows: List[tuple], args: Sequence[Any] = ()):
+        """Cache the result of a SQL query that ran in a READ ONLY transaction."""
+        if not self.cacheable(sql):
+            return
+        size = len(json.dumps(rows, default=str))
+        if size > self.max_entry_bytes:
+            self.counters["too_large"] += 1
+            return
+        key = cache_key(sql, args)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (rows, size, time.monotonic())
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def invalidate_table(self, table: str):
+        """Drop every cached result that read from `table`."""
+        for key in [k for k in self._entries if referenced_tables(k, [table])]:
+            self._remove(key)
+            self.counters["invalidations"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "enabled": self.enabled,
+        }
+
+
+RESULT_CACHE = ResultCache()
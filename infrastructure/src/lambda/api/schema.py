@@ -0,0 +1,162 @@
+import asyncio
+import os
+import re
+import time
+from itertools import groupby
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+# How often to ask postgres whether the schema changed. The check is a single row
+# lookup but there is no need to make it on every request.
+SCHEMA_CACHE_CHECK_SECONDS = float(os.getenv("SCHEMA_CACHE_CHECK_SECONDS", "30"))
+# Tables the API uses for itself which the LLM should never query.
+SCHEMA_EXCLUDED_TABLES = [
+    t.strip()
+    for t in os.getenv(
+        "SCHEMA_EXCLUDED_TABLES",
+        "queries,user_queries,embedding_cache,schema_version,table_versions,schema_embeddings",
+    ).split(",")
+    if t.strip()
+]
+
+TABLE_QUERY = """
+SELECT
+    table_schema,
+    table_name,
+    column_name,
+    data_type,
+    is_nullable
+FROM
+    information_schema.columns
+WHERE
+    table_schema NOT IN ('information_schema', 'pg_catalog')
+    AND table_name <> ALL($1::text[])
+ORDER BY
+    table_schema,
+    table_name,
+    ordinal_position;
+"""
+
+# setup_db.py installs an event trigger which bumps this counter on every DDL command.
+VERSION_QUERY = "SELECT version::text FROM schema_version WHERE id = 1"
+
+# If the trigger isn't installed fall back to a checksum of the catalog rows describing
+# user tables and columns. Any DDL touching them writes a new row version (xmin).
+CHECKSUM_QUERY = """
+SELECT md5(string_agg(a.attrelid::text || '.' || a.attnum || '.' || a.xmin::text || '.' || c.xmin::text, ',' ORDER BY a.attrelid, a.attnum))
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'v', 'm', 'p', 'f')
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg_toast%'
+"""
+
+_SIMPLE_IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def quote_identifier(name: str) -> str:
+    """Quote an identifier only when postgres needs it, e.g. "Annual Revenue"."""
+    if _SIMPLE_IDENTIFIER.match(name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def render_schema(rows: List[Tuple[str, str, str, str, str]]) -> str:
+    """Render information_schema rows as one compact line per table.
+
+    e.g. `public.all_companies: "Company name" text, "Annual Revenue" double precision`
+    """
+    lines = []
+    for (table_schema, table_name), columns in groupby(rows, key=lambda r: r[:2]):
+        rendered = [
+            f"{quote_identifier(column)} {data_type}"
+            + (" NOT NULL" if is_nullable == "NO" else "")
+            for _, _, column, data_type, is_nullable in columns
+        ]
+        lines.append(
+            f"{quote_identifier(table_schema)}.{quote_identifier(table_name)}: "
+            + ", ".join(rendered)
+        )
+    return "\n".join(lines)
+
+
+class SchemaContextCache:
+    """Holds the rendered schema context and refreshes it only when the DDL changes.
+
+    :param check_seconds: The minimum time between schema version checks.
+    :param excluded_tables: Tables to leave out of the context.
+    """
+
+    def __init__(
+        self,
+        check_seconds: float = SCHEMA_CACHE_CHECK_SECONDS,
+        excluded_tables: List[str] = SCHEMA_EXCLUDED_TABLES,
+    ):
+        self.check_seconds = check_seconds
+        self.excluded_tables = excluded_tables
+        self.version: Optional[str] = None
+        self.text: Optional[str] = None
+        self.checked_at = 0.0
+        self.use_trigger = True
+        self.counters = {"hits": 0, "refreshes": 0}
+        self._lock = asyncio.Lock()
+
+    async def _current_version(self, conn: asyncpg.Connection) -> str:
+        if self.use_trigger:
+            try:
+                version = await conn.fetchval(VERSION_QUERY)
+                if version is not None:
+                    return version
+            except asyncpg.UndefinedTableError:
+                pass
+            print("schema_version trigger not installed, using catalog checksums.")
+            self.use_trigger = False
+        return await conn.fetchval(CHECKSUM_QUERY)
+
+    async def get(self, conn: asyncpg.Connection) -> str:
+        """Get the rendered schema, refreshing it if the database schema changed.
+
+        Concurrent callers wait for a single refresh instead of all querying postgres.
+
+        :param conn: An asyncpg connection or pool used for the version check and refresh.
+        """
+        if (
+            self.text is not None
+            and time.monotonic() - self.checked_at < self.check_seconds
+        ):
+            self.counters["hits"] += 1
+            return self.text
+        async with self._lock:
+            now = time.monotonic()
+            if self.text is not None and now - self.checked_at < self.check_seconds:
+                self.counters["hits"] += 1
+                return self.text
+            version = await self._current_version(conn)
+            self.checked_at = now
+            if self.text is not None and version == self.version:
+                self.counters["hits"] += 1
+                return self.text
+            rows = await conn.fetch(TABLE_QUERY, self.excluded_tables)
+            self.text = render_schema([tuple(r) for r in rows])
+            self.version = version
+            self.counters["refreshes"] += 1
+            return self.text
+
+    def invalidate(self):
+        self.text = None
+        self.version = None
+
+    def stats(self):
+        return {
+            **self.counters,
+            "version": self.version,
+            "chars": len(self.text) if self.text else 0,
+            "source": "trigger" if self.use_trigger else "checksum",
+        }
+
+
+SCHEMA_CACHE = SchemaContextCache()
@@ -0,0 +1,276 @@
+import asyncio
+import os
+import re
+import traceback
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from embeddings import get_embeddings
+from schema import SCHEMA_EXCLUDED_TABLES, TABLE_QUERY, render_schema
+
+# Only send the LLM the tables and columns closest to the question instead of the whole
+# schema. Needs the schema_embeddings table created by setup_db.py.
+SCHEMA_RETRIEVAL_ENABLED = (
+    os.getenv("SCHEMA_RETRIEVAL_ENABLED", "false").lower() == "true"
+)
+# Schemas with fewer columns than this are sent whole, pruning would save next to nothing
+# and risks leaving out a column the query needs.
+SCHEMA_RETRIEVAL_MIN_COLUMNS = int(os.getenv("SCHEMA_RETRIEVAL_MIN_COLUMNS", "100"))
+# The most tables in the prompt, and the number of nearest column descriptions whose
+# columns are kept. Tables only matched by their own description keep every column.
+SCHEMA_RETRIEVAL_TABLES = int(os.getenv("SCHEMA_RETRIEVAL_TABLES", "5"))
+SCHEMA_RETRIEVAL_COLUMNS = int(os.getenv("SCHEMA_RETRIEVAL_COLUMNS", "30"))
+# The most common values of a column (from pg_stats) added to its description. They're
+# read when the schema version changes, an ANALYZE on its own doesn't refresh them.
+SCHEMA_SAMPLE_VALUES = int(os.getenv("SCHEMA_SAMPLE_VALUES", "3"))
+
+SAMPLES_QUERY = """
+SELECT schemaname, tablename, attname, (most_common_vals::text::text[])[1:$1] AS samples
+FROM pg_stats
+WHERE schemaname NOT IN ('information_schema', 'pg_catalog')
+    AND tablename <> ALL($2::text[])
+    AND most_common_vals IS NOT NULL
+"""
+
+# Primary and foreign key columns are always kept so the tables can still be joined.
+KEY_COLUMNS_QUERY = """
+SELECT table_schema, table_name, column_name
+FROM information_schema.key_column_usage
+WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
+"""
+
+UPSERT_QUERY = """
+INSERT INTO schema_embeddings (key, table_schema, table_name, column_name, description, embedding)
+VALUES ($1, $2, $3, $4, $5, $6)
+ON CONFLICT (key) DO UPDATE SET description = EXCLUDED.description, embedding = EXCLUDED.embedding
+"""
+
+_NAME_SEPARATORS = re.compile(r"[\W_]+")
+
+SEARCH_QUERY = """
+SELECT table_schema, table_name, column_name
+FROM schema_embeddings
+ORDER BY embedding <=> $1
+LIMIT $2
+"""
+
+
+def name_words(name: str) -> str:
+    """Split an identifier into words for embedding, e.g. Country/Region or deal_stage."""
+    return _NAME_SEPARATORS.sub(" ", name).strip().lower()
+
+
+def describe_schema(
+    rows: List[Tuple[str, str, str, str, str]],
+    samples: Dict[Tuple[str, str, str], List[str]],
+) -> Dict[str, Tuple[str, str, Optional[str], str]]:
+    """Describe every table and column in words for embedding.
+
+    :param rows: information_schema rows as used by `render_schema`.
+    :param samples: Common values of each (schema, table, column).
+    :return: key -> (table_schema, table_name, column_name or None, description)
+    """
+    docs = {}
+    columns: Dict[Tuple[str, str], List[str]] = {}
+    for table_schema, table_name, column, data_type, _ in rows:
+        columns.setdefault((table_schema, table_name), []).append(column)
+        description = f"{name_words(column)} ({data_type}) in {name_words(table_name)}"
+        values = samples.get((table_schema, table_name, column))
+        if values:
+            description += ", e.g. " + ", ".join(str(v)[:40] for v in values)
+        key = f"{table_schema}.{table_name}.{column}"
+        docs[key] = (table_schema, table_name, column, description)
+    for (table_schema, table_name), names in columns.items():
+        description = f"{name_words(table_name)}: " + ", ".join(
+            name_words(n) for n in names
+        )
+        docs[f"{table_schema}.{table_name}"] = (
+            table_schema,
+            table_name,
+            None,
+            description,
+        )
+    return docs
+
+
+class SchemaIndex:
+    """Embeddings of the schema's tables and columns for pruning the LLM's context.
+
+    A description of every table and column (name, type and a few common values) is
+    embedded into the schema_embeddings table. Whenever the schema version changes the
+    descriptions are rebuilt and only the ones whose text changed are embedded again,
+    so the work is shared by every container and done once per schema change. The
+    common values come from pg_stats at that time and go stale as ANALYZE updates the
+    statistics, they're only meant as hints and are refreshed with the next schema change.
+
+    A container syncs during prewarm. A request that finds the index behind the schema
+    version starts a sync in the background and gets the whole schema until it's done,
+    on lambda the sync carries on in the following invocations.
+
+    The pruned schema has the tables of the nearest descriptions. Of each table it keeps
+    the columns among the nearest column descriptions plus its key columns, or every
+    column when only the table's own description matched.
+
+    :param enabled: Prune the schema at all.
+    :param min_columns: Send schemas with fewer columns whole.
+    :param tables: The most tables to keep.
+    :param columns: The number of nearest column descriptions to keep.
+    :param sample_values: Common values added to each column's description.
+    :param excluded_tables: Tables to leave out, like the schema cache does.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SCHEMA_RETRIEVAL_ENABLED,
+        min_columns: int = SCHEMA_RETRIEVAL_MIN_COLUMNS,
+        tables: int = SCHEMA_RETRIEVAL_TABLES,
+        columns: int = SCHEMA_RETRIEVAL_COLUMNS,
+        sample_values: int = SCHEMA_SAMPLE_VALUES,
+        excluded_tables: List[str] = SCHEMA_EXCLUDED_TABLES,
+    ):
+        self.enabled = enabled
+        self.min_columns = min_columns
+        self.tables = tables
+        self.columns = columns
+        self.sample_values = sample_values
+        self.excluded_tables = excluded_tables
+        self.version: Optional[str] = None
+        self.rows: List[Tuple[str, str, str, str, str]] = []
+        self.key_columns: Set[Tuple[str, str, str]] = set()
+        self.synced = False
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"syncs": 0, "embedded": 0, "pruned": 0, "full": 0}
+
+    async def sync(self, pool: asyncpg.Pool, version: Optional[str]):
+        """Bring schema_embeddings up to date with a schema version.
+
+        :param pool: The asyncpg pool.
+        :param version: The schema version from the schema cache.
+        """
+        if version is not None and version == self.version:
+            return
+        async with self._lock:
+            if version is not None and version == self.version:
+                return
+            async with pool.acquire() as conn:
+                rows = [
+                    tuple(r)
+                    for r in await conn.fetch(TABLE_QUERY, self.excluded_tables)
+                ]
+                samples = {}
+                try:
+                    for r in await conn.fetch(
+                        SAMPLES_QUERY, self.sample_values, self.excluded_tables
+                    ):
+                        samples[tuple(r[:3])] = r["samples"]
+                except asyncpg.PostgresError:
+                    # Common values of some types can't be read back as text.
+                    print("Couldn't read column samples from pg_stats.")
+                keys = {tuple(r) for r in await conn.fetch(KEY_COLUMNS_QUERY)}
+                stored = {
+                    r["key"]: r["description"]
+                    for r in await conn.fetch(
+                        "SELECT key, description FROM schema_embeddings"
+                    )
+                }
+
+            docs = describe_schema(rows, samples)
+            changed = [k for k, doc in docs.items() if stored.get(k) != doc[3]]
+            embeddings = await get_embeddings([docs[k][3] for k in changed])
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(
+                        UPSERT_QUERY,
+                        [(k, *docs[k], e) for k, e in zip(changed, embeddings)],
+                    )
+                    await conn.execute(
+                        "DELETE FROM schema_embeddings WHERE key <> ALL($1::text[])",
+                        list(docs),
+                    )
+            self.rows = rows
+            self.key_columns = keys
+            self.version = version
+            self.synced = True
+            self.counters["syncs"] += 1
+            self.counters["embedded"] += len(changed)
+
+    def sync_in_background(self, pool: asyncpg.Pool, version: Optional[str]):
+        """Start `sync` as a task on the running loop unless one is already running."""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done():
+            if self._task.get_loop() is loop:
+                return
+        self._task = loop.create_task(self._background_sync(pool, version))
+
+    async def _background_sync(self, pool: asyncpg.Pool, version: Optional[str]):
+        try:
+            await self.sync(pool, version)
+        except asyncpg.UndefinedTableError:
+            print("schema_embeddings doesn't exist, sending the whole schema.")
+            self.enabled = False
+        except Exception:
+            print(traceback.format_exc())
+
+    async def context(
+        self,
+        pool: asyncpg.Pool,
+        embedding: List[float],
+        full_context: str,
+        version: Optional[str],
+    ) -> str:
+        """Get the schema context for a question, pruned if the schema is large.
+
+        :param pool: The asyncpg pool.
+        :param embedding: The embedding of the question.
+        :param full_context: The whole schema, returned when it isn't pruned.
+        :param version: The schema version of `full_context`.
+        """
+        if not self.enabled:
+            return full_context
+        if not self.synced or (version is not None and version != self.version):
+            # Embedding the changed descriptions shouldn't hold up this question.
+            self.sync_in_background(pool, version)
+            self.counters["full"] += 1
+            return full_context
+        if len(self.rows) < self.min_columns:
+            self.counters["full"] += 1
+            return full_context
+
+        hits = await pool.fetch(SEARCH_QUERY, embedding, self.tables + self.columns)
+        tables: List[Tuple[str, str]] = []
+        columns: Dict[Tuple[str, str], Set[str]] = {}
+        for table_schema, table_name, column in hits:
+            table = (table_schema, table_name)
+            if table not in columns:
+                if len(tables) == self.tables:
+                    continue
+                tables.append(table)
+                columns[table] = set()
+            if column is not None:
+                columns[table].add(column)
+        keep = [
+            row
+            for row in self.rows
+            if row[:2] in columns
+            and (
+                not columns[row[:2]]
+                or row[2] in columns[row[:2]]
+                or row[:3] in self.key_columns
+            )
+        ]
+        self.counters["pruned"] += 1
+        return render_schema(keep)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "enabled": self.enabled,
+            "version": self.version,
+            "columns": len(self.rows),
+            "syncing": self._task is not None and not self._task.done(),
+        }
+
+
+SCHEMA_INDEX = SchemaIndex()
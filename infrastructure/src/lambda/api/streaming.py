@@ -0,0 +1,134 @@
+import datetime
+import decimal
+import json
+import os
+import uuid
+from contextlib import aclosing
+from typing import Any, AsyncIterator, List, Optional, Sequence
+
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from db import get_async_pool, to_row
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# The number of rows fetched from the server side cursor at a time.
+STREAM_ITERSIZE = int(os.getenv("STREAM_ITERSIZE", "2000"))
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """Check if the Accept header asks for newline delimited JSON."""
+    return accept is not None and NDJSON_MEDIA_TYPE in accept
+
+
+def json_default(value: Any) -> Any:
+    """Encode the postgres types the json module doesn't know about."""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return str(value)
+
+
+def encode_ndjson(rows: List[tuple]) -> bytes:
+    """Encode rows as one JSON array per line."""
+    return "".join(
+        json.dumps(row, default=json_default) + "\n" for row in rows
+    ).encode()
+
+
+class ServerCursor:
+    """A server side cursor on a pooled connection that yields rows in batches.
+
+    The statement and its first batch run in `open` so errors are raised to the caller
+    (and can be retried) instead of failing halfway through a response. The pooled
+    connection is held until `batches` is exhausted or `close` is called.
+
+    :param sql: The SQL statement to run.
+    :param itersize: The number of rows fetched per round trip.
+    :param args: The values of the statement's $n parameters.
+    """
+
+    def __init__(
+        self, sql: str, itersize: int = STREAM_ITERSIZE, args: Sequence[Any] = ()
+    ):
+        self.sql = sql
+        self.itersize = itersize
+        self.args = args
+        self.attributes = ()
+        self._first_batch: List[Any] = []
+        self._conn = None
+        self._committed = False
+
+    async def open(self) -> "ServerCursor":
+        self._pool = await get_async_pool()
+        self._conn = await self._pool.acquire()
+        self._transaction = self._conn.transaction()
+        try:
+            # asyncpg cursors only exist inside a transaction.
+            await self._transaction.start()
+            statement = await self._conn.prepare(self.sql)
+            # The column names and types, available before any rows are fetched.
+            self.attributes = statement.get_attributes()
+            self._cursor = await statement.cursor(*self.args)
+            self._first_batch = await self._cursor.fetch(self.itersize)
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def batches(self) -> AsyncIterator[List[Any]]:
+        """Yield batches of asyncpg records then give the connection back."""
+        try:
+            batch = self._first_batch
+            while batch:
+                yield batch
+                if len(batch) < self.itersize:
+                    break
+                batch = await self._cursor.fetch(self.itersize)
+            await self._transaction.commit()
+            self._committed = True
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Roll back unless every batch was read and give the connection back.
+
+        Safe to call more than once.
+        """
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            if not self._committed and conn.is_in_transaction():
+                await self._transaction.rollback()
+        finally:
+            await self._pool.release(conn)
+
+
+async def stream_sql(
+    sql: str, *args: Any, itersize: int = STREAM_ITERSIZE
+) -> StreamingResponse:
+    """Run a SQL statement through a server side cursor and stream the rows as NDJSON.
+
+    Rows are fetched `itersize` at a time so memory stays flat however large the
+    result is, and the first rows are sent as soon as postgres produces them. The
+    connection is also released by a background task, which runs after the response
+    even if the body was never iterated, e.g. the client went away first.
+
+    :param sql: The SQL statement to run.
+    :param args: The values of the statement's $n parameters.
+    :param itersize: The number of rows fetched per round trip.
+    """
+    cursor = await ServerCursor(sql, itersize, args).open()
+
+    async def body() -> AsyncIterator[bytes]:
+        async with aclosing(cursor.batches()) as batches:
+            async for batch in batches:
+                yield encode_ndjson([to_row(r) for r in batch])
+
+    return StreamingResponse(
+        body(), media_type=NDJSON_MEDIA_TYPE, background=BackgroundTask(cursor.close)
+    )
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+import asyncpg
+
+# Rank the query templates in memory instead of asking pgvector on every request.
+TEMPLATE_INDEX_ENABLED = os.getenv("TEMPLATE_INDEX_ENABLED", "false").lower() == "true"
+# How often to look for templates added (or removed) by other containers.
+TEMPLATE_INDEX_REFRESH_SECONDS = float(
+    os.getenv("TEMPLATE_INDEX_REFRESH_SECONDS", "30")
+)
+
+NEW_TEMPLATES_QUERY = """
+SELECT id, name, query, args, arg_types, embedding::real[] AS embedding
+FROM queries
+WHERE id > $1 AND embedding IS NOT NULL
+ORDER BY id
+"""
+COUNT_QUERY = "SELECT count(*) FROM queries WHERE embedding IS NOT NULL"
+
+
+class TemplateIndex:
+    """An exact in memory copy of the queries table for template retrieval.
+
+    The embeddings live in one contiguous float32 matrix with normalized rows so a
+    search is a single matrix vector product plus an argpartition for the top k. The
+    rest of each row is kept in plain lists in the same order.
+
+    Every `refresh_seconds` only the rows with an id above the highest one loaded are
+    fetched and appended. If the number of rows in postgres no longer matches (a
+    template was deleted) everything is reloaded. Templates updated in place are only
+    picked up by `invalidate`.
+
+    The score is the cosine distance, 1 - cosine similarity, the same as pgvector's
+    `<=>` so the `< 0.1` template threshold means the same thing on both paths.
+
+    :param enabled: Use the index instead of pgvector.
+    :param refresh_seconds: How often to check postgres for new templates.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = TEMPLATE_INDEX_ENABLED,
+        refresh_seconds: float = TEMPLATE_INDEX_REFRESH_SECONDS,
+    ):
+        self.enabled = enabled
+        self.refresh_seconds = refresh_seconds
+        self.checked_at = 0.0
+        self.watermark = 0
+        # The first `size` rows of the matrix are in use, the rest is room to grow.
+        self.size = 0
+        self._matrix = None
+        self._names: List[str] = []
+        self._queries: List[str] = []
+        self._args: List[List[str]] = []
+        self._arg_types: List[List[str]] = []
+        self._stale = False
+        self._lock = asyncio.Lock()
+        self.counters = {"searches": 0, "refreshes": 0, "added": 0, "reloads": 0}
+
+    async def refresh(self, conn: asyncpg.Connection, force: bool = False):
+        """Load templates added since the last refresh, at most every refresh_seconds.
+
+        :param conn: An asyncpg connection or pool.
+        :param force: Check now however recently the last check was.
+        """
+        if not force and time.monotonic() - self.checked_at < self.refresh_seconds:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if not force and now - self.checked_at < self.refresh_seconds:
+                return
+            rows = await conn.fetch(NEW_TEMPLATES_QUERY, self.watermark)
+            total = await conn.fetchval(COUNT_QUERY)
+            if self._stale or total != self.size + len(rows):
+                rows = await conn.fetch(NEW_TEMPLATES_QUERY, 0)
+                # Searches keep using the old rows until the new ones are all fetched.
+                self._clear()
+                self.counters["reloads"] += 1
+            self._append(rows)
+            self._stale = False
+            self.checked_at = now
+            self.counters["refreshes"] += 1
+
+    def _clear(self):
+        self.watermark = 0
+        self.size = 0
+        self._matrix = None
+        self._names, self._queries, self._args, self._arg_types = [], [], [], []
+
+    def _append(self, rows: List[asyncpg.Record]):
+        if not rows:
+            return
+        import numpy as np
+
+        vectors = np.array([r["embedding"] for r in rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        needed = self.size + len(rows)
+        if self._matrix is None or needed > len(self._matrix):
+            # Grow by doubling so adding templates one at a time stays cheap.
+            matrix = np.empty(
+                (max(needed, 2 * self.size), vectors.shape[1]), np.float32
+            )
+            if self._matrix is not None:
+                matrix[: self.size] = self._matrix[: self.size]
+            self._matrix = matrix
+        self._matrix[self.size : needed] = vectors
+        self._names.extend(r["name"] for r in rows)
+        self._queries.extend(r["query"] for r in rows)
+        self._args.extend(r["args"] for r in rows)
+        self._arg_types.extend(r["arg_types"] for r in rows)
+        # Searches only read the first `size` rows so bump it once the rows are in.
+        self.size = needed
+        self.watermark = rows[-1]["id"]
+        self.counters["added"] += len(rows)
+
+    def invalidate(self):
+        """Reload everything on the next refresh, e.g. after templates were edited."""
+        self._stale = True
+        self.checked_at = 0.0
+
+    def mark_changed(self):
+        """Look for new templates on the next refresh, e.g. after adding some."""
+        self.checked_at = 0.0
+
+    def search(self, embedding: List[float], n: int = 3) -> List[Tuple[Any, ...]]:
+        """Find the n templates closest to an embedding.
+
+        :return: (name, query, args, arg_types, distance) rows ordered by distance like
+            `get_similar`.
+        """
+        import numpy as np
+
+        self.counters["searches"] += 1
+        size = self.size
+        if size == 0 or n <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        scores = self._matrix[:size] @ (query / norm if norm else query)
+        if n < size:
+            top = np.argpartition(-scores, n - 1)[:n]
+            top = top[np.argsort(-scores[top], kind="stable")]
+        else:
+            top = np.argsort(-scores, kind="stable")
+        return [
+            (
+                self._names[i],
+                self._queries[i],
+                self._args[i],
+                self._arg_types[i],
+                1.0 - float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "enabled": self.enabled,
+            "size": self.size,
+            "watermark": self.watermark,
+            "bytes": 0 if self._matrix is None else self._matrix.nbytes,
+        }
+
+
+TEMPLATE_INDEX = TemplateIndex()
@@ -0,0 +1,195 @@
+import functools
+import json
+import os
+import re
+from string import Formatter
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Args which can't be bound as parameters, e.g. the direction in `ORDER BY x {order}`,
+# are expanded into the SQL text but only with one of these values.
+TEMPLATE_ARG_WHITELIST: Dict[str, List[str]] = json.loads(
+    os.getenv("TEMPLATE_ARG_WHITELIST", '{"order": ["ASC", "DESC"]}')
+)
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "256"))
+
+_NUMBER = re.compile(r"^-?\d+(\.\d+)?([eE][-+]?\d+)?$")
+# Template names become OpenAI tool names.
+_TOOL_NAME = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+ARG_TYPES = ("string", "number", "integer", "boolean")
+
+
+class TemplateError(ValueError):
+    """Raised when a template can't be compiled or an argument value isn't allowed."""
+
+
+def coerce_arg(name: str, value: Any, arg_type: str) -> Any:
+    """Convert an argument from the LLM to the python type of its JSON schema type.
+
+    GPT doesn't always know when to use a number or a string so numbers given as
+    strings are accepted.
+    """
+    if value is None:
+        return None
+    if arg_type in ("number", "integer"):
+        if isinstance(value, bool):
+            raise TemplateError(f"{name} should be a {arg_type}, got {value!r}")
+        if isinstance(value, str):
+            if not _NUMBER.match(value.strip()):
+                raise TemplateError(f"{name} should be a {arg_type}, got {value!r}")
+            value = float(value)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if arg_type == "integer" and not isinstance(value, int):
+            raise TemplateError(f"{name} should be an integer, got {value!r}")
+        return value
+    if arg_type == "boolean":
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        if not isinstance(value, bool):
+            raise TemplateError(f"{name} should be a boolean, got {value!r}")
+        return value
+    return value if isinstance(value, str) else str(value)
+
+
+class CompiledTemplate:
+    """A stored query template split into SQL text and parameter slots.
+
+    Every `{arg}` becomes a bind parameter (`$1`, `$2`, ...) so postgres parses and
+    plans the statement once per connection however the args change. Args in the
+    whitelist are expanded into the text instead, after checking the value. A `{arg}`
+    inside a quoted string becomes a parameter concatenated into the string.
+
+    :param query: The template, e.g. `... WHERE "Likelihood to close" >= {threshold}`.
+    :param args: The arg names.
+    :param arg_types: The JSON schema type of each arg.
+    :param whitelist: The allowed values of args expanded into the text.
+    """
+
+    def __init__(
+        self,
+        query: str,
+        args: Sequence[str],
+        arg_types: Sequence[str],
+        whitelist: Dict[str, List[str]] = TEMPLATE_ARG_WHITELIST,
+    ):
+        self.query = query
+        self.arg_types = dict(zip(args, arg_types))
+        self.whitelist = {k.lower(): v for k, v in whitelist.items()}
+        # ("text", str) or ("param", name) or ("keyword", name) or ("string", name)
+        self.parts: List[Tuple[str, str]] = []
+        # The args in parameter order, each arg is bound once however often it's used.
+        self.params: List[str] = []
+        self._compile(query.strip())
+
+    def _compile(self, query: str):
+        # Track whether each placeholder sits in a string, a quoted identifier or a
+        # comment. Apostrophes in comments don't start strings.
+        state = None
+        for literal, field, spec, conversion in Formatter().parse(query):
+            i = 0
+            while i < len(literal):
+                char, pair = literal[i], literal[i : i + 2]
+                if state is None:
+                    if pair in ("--", "/*"):
+                        state, i = pair, i + 1
+                    elif char in ("'", '"'):
+                        state = char
+                elif state == char and state in ("'", '"'):
+                    state = None
+                elif state == "--" and char == "\n":
+                    state = None
+                elif state == "/*" and pair == "*/":
+                    state, i = None, i + 1
+                i += 1
+            self.parts.append(("text", literal))
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                raise TemplateError(f"Unsupported placeholder {{{field}}}")
+            if state in ("--", "/*"):
+                self.parts.append(("text", f"{{{field}}}"))
+            elif field.lower() in self.whitelist:
+                self.parts.append(("keyword", field))
+            elif state == '"':
+                raise TemplateError(f"{{{field}}} is an identifier but not whitelisted")
+            else:
+                self.parts.append(("string" if state == "'" else "param", field))
+                if field not in self.params:
+                    self.params.append(field)
+
+    def render(self, values: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        """Build the SQL text and the `$1` bind values for a set of arg values.
+
+        :param values: The arg values, e.g. the arguments of an OpenAI tool call.
+        :return: The SQL and the bind values.
+        """
+        missing = [p for p in self.params if p not in values]
+        if missing:
+            raise TemplateError(f"Missing values for {', '.join(missing)}")
+        binds = {
+            p: coerce_arg(p, values[p], self.arg_types.get(p, "string"))
+            for p in self.params
+        }
+        sql = []
+        for kind, value in self.parts:
+            if kind == "text":
+                sql.append(value)
+                continue
+            if kind == "keyword":
+                sql.append(self._expand(value, values.get(value)))
+                continue
+            param = f"${self.params.index(value) + 1}"
+            sql.append(f"' || {param}::text || '" if kind == "string" else param)
+        return "".join(sql), [binds[p] for p in self.params]
+
+    def _expand(self, name: str, value: Any) -> str:
+        allowed = self.whitelist[name.lower()]
+        for option in allowed:
+            if str(value).strip().lower() == option.lower():
+                return option
+        raise TemplateError(
+            f"{name} must be one of {', '.join(allowed)}, got {value!r}"
+        )
+
+
+def check_template(
+    name: str, query: str, args: Sequence[str], arg_types: Sequence[str]
+) -> CompiledTemplate:
+    """Check a template before it's stored, raising a TemplateError if it can't be used.
+
+    The name has to be a valid tool name, every arg needs a known type, and every
+    placeholder in the query has to be one of the args.
+    """
+    if not _TOOL_NAME.match(name):
+        raise TemplateError(
+            f"name {name!r} should be 1 to 64 letters, digits, underscores or dashes"
+        )
+    if len(args) != len(arg_types):
+        raise TemplateError(f"got {len(args)} args but {len(arg_types)} arg_types")
+    if len(set(args)) != len(args):
+        raise TemplateError("args should be unique")
+    unknown = [t for t in arg_types if t not in ARG_TYPES]
+    if unknown:
+        raise TemplateError(
+            f"arg_types should be one of {', '.join(ARG_TYPES)}, got {unknown}"
+        )
+    template = compile_template(query, args, arg_types)
+    placeholders = {v for kind, v in template.parts if kind != "text"}
+    missing = sorted(placeholders - set(args))
+    if missing:
+        raise TemplateError(f"placeholders {', '.join(missing)} aren't in args")
+    return template
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template(
+    query: str, args: Tuple[str, ...], arg_types: Tuple[str, ...]
+) -> CompiledTemplate:
+    return CompiledTemplate(query, args, arg_types)
+
+
+def compile_template(
+    query: str, args: Sequence[str], arg_types: Sequence[str]
+) -> CompiledTemplate:
+    """Compile a stored template once and reuse it for every later call."""
+    return _compile_template(query, tuple(args), tuple(arg_types or ()))
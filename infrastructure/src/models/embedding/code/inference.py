@@ -1,8 +1,16 @@
 import json
-from typing import Any, Dict, List
+import os
+from typing import Any, Dict, List, Union
 
 from sentence_transformers import SentenceTransformer
 
+# The number of texts encoded per forward pass when a request contains a list of texts.
+BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# Requests from different callers aren't merged here. Each model server worker handles
+# one request at a time and the HF toolkit only hands the first request of a server
+# side batch to transform_fn, so there is never anything to merge with. Callers batch
+# their own texts by sending {"texts": [...]}.
+
 
 def model_fn(model_dir=None):
     model_name = "thenlper/gte-small"
@@ -11,6 +19,17 @@ def model_fn(model_dir=None):
 
 def transform_fn(
     model: SentenceTransformer, input_data, content_type, accept
-) -> List[List[Dict[str, Any]]]:
-    data = json.loads(input_data)
-    return model.encode(data["text"]).tolist()
+) -> Union[List[float], List[List[float]]]:
+    """Embed the text in the request.
+
+    The request is either `{"text": "..."}`, which returns a single vector, or
+    `{"texts": ["...", ...]}`, which encodes every text in one batched call and
+    returns a list of vectors in the same order. An optional `batch_size` overrides
+    the default number of texts per forward pass.
+    """
+    data: Dict[str, Any] = json.loads(input_data)
+    texts = data.get("texts", data.get("text"))
+    if isinstance(texts, str):
+        return model.encode(texts).tolist()
+    batch_size = int(data.get("batch_size", BATCH_SIZE))
+    return model.encode(texts, batch_size=batch_size).tolist()
@@ -0,0 +1,75 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import AutoModel, AutoTokenizer
+
+
+def export_onnx(model_name: str, output_dir: str, opset: int = 17) -> str:
+    """Export a sentence-transformers model to ONNX and quantize its weights to int8.
+
+    The exported graph returns the token embeddings, pooling and normalization are
+    done by the API (LocalEmbeddingBackend in lambda/api/embeddings.py).
+
+    :param model_name: The huggingface name of the model, e.g. thenlper/gte-small.
+    :param output_dir: Where to write model.onnx and tokenizer.json.
+    :param opset: The ONNX opset version.
+    :return: The path of the quantized model.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["an example question"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fp32_path = os.path.join(tmp_dir, "model.fp32.onnx")
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                tuple(sample[name] for name in input_names),
+                fp32_path,
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=opset,
+            )
+        # Dynamic quantization stores the weights as int8 and quantizes activations on
+        # the fly, no calibration data needed.
+        quantized_path = os.path.join(tmp_dir, "model.onnx")
+        quantize_dynamic(fp32_path, quantized_path, weight_type=QuantType.QInt8)
+        shutil.copy(quantized_path, os.path.join(output_dir, "model.onnx"))
+
+    # The fast tokenizer serializes to the tokenizer.json read by the tokenizers library.
+    tokenizer.backend_tokenizer.save(os.path.join(output_dir, "tokenizer.json"))
+    return os.path.join(output_dir, "model.onnx")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the embedding model to int8 ONNX for the local backend"
+    )
+    parser.add_argument("--model-name", default="thenlper/gte-small")
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..",
+            "lambda",
+            "api",
+            "models",
+            "gte-small-int8",
+        ),
+        help="Defaults to the folder the lambda Dockerfile copies into the image",
+    )
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    path = export_onnx(args.model_name, args.output_dir, args.opset)
+    print(f"Wrote {path} ({os.path.getsize(path) / 1024 ** 2:.1f}MB)")
@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+API_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "infrastructure",
+    "src",
+    "lambda",
+    "api",
+)
+# One line per imported module: "import time: self [us] | cumulative | name".
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)")
+
+# Runs in a fresh interpreter so nothing is imported already, like a new container.
+INIT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import main
+total = time.perf_counter() - start
+print(json.dumps({"import_main_ms": total * 1000, "cold_start": main.COLD_START.report()}))
+"""
+
+
+def run_init(env: Dict[str, str]) -> Dict:
+    """Import main in a new python process and collect both timing reports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", INIT_SCRIPT],
+        cwd=API_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    packages = defaultdict(float)
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        # Charge each module's own time to its top level package, whoever imported it.
+        if match:
+            packages[match.group(3).split(".")[0]] += int(match.group(1)) / 1000
+    report["imports_ms"] = dict(packages)
+    return report
+
+
+def summarize(runs: List[Dict], top: int) -> Dict:
+    """Take the median of every number over the runs."""
+    phases = defaultdict(list)
+    imports = defaultdict(list)
+    for run in runs:
+        for phase, ms in run["cold_start"]["phases_ms"].items():
+            phases[phase].append(ms)
+        for package, ms in run["imports_ms"].items():
+            imports[package].append(ms)
+    imports_ms = {p: round(statistics.median(v), 2) for p, v in imports.items()}
+    slowest = sorted(imports_ms.items(), key=lambda kv: -kv[1])[:top]
+    return {
+        "version": runs[0]["cold_start"]["version"],
+        "runs": len(runs),
+        "import_main_ms": round(
+            statistics.median(r["import_main_ms"] for r in runs), 2
+        ),
+        "init_ms": statistics.median(r["cold_start"]["init_ms"] for r in runs),
+        "phases_ms": {p: round(statistics.median(v), 2) for p, v in phases.items()},
+        "slowest_imports_ms": dict(slowest),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the import and init time of the API's lambda container"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--prewarm",
+        default="",
+        help="Also time these PREWARM steps, they need the database and credentials",
+    )
+    parser.add_argument(
+        "--top", type=int, default=15, help="How many of the slowest imports to list"
+    )
+    parser.add_argument(
+        "--version",
+        default=None,
+        help="The release the numbers belong to, e.g. a git tag",
+    )
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    env = {**os.environ, "PREWARM": args.prewarm}
+    if args.prewarm:
+        # Prewarming only runs during lambda init.
+        env.setdefault("AWS_LAMBDA_FUNCTION_NAME", "profile-cold-start")
+        env.setdefault("PAGE_TOKEN_SECRET", "profile-cold-start")
+    if args.version:
+        env["AWS_LAMBDA_FUNCTION_VERSION"] = args.version
+
+    runs = [run_init(env) for _ in range(args.runs)]
+    results = summarize(runs, args.top)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,13 +1,12 @@
-import pandas as pd
-import os
 import argparse
-import json
-import boto3
 from utils import (
     get_secret,
-    create_sqlalchemy_connection,
+    get_embeddings,
     create_connection,
+    load_seed_directory,
     add_query_to_db,
+    create_vector_index,
+    reindex_vector_index,
 )
 
 
@@ -36,6 +35,47 @@ if __name__ == "__main__":
         default=True,
         help="The path to a folder of csvs you want to create tables for",
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100_000,
+        help="The number of csv rows parsed and copied into postgres at a time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of seed files to load in parallel, each uses one connection",
+    )
+    parser.add_argument(
+        "--index-type",
+        choices=["hnsw", "ivfflat", "none"],
+        default="hnsw",
+        help="The ANN index to build on queries.embedding",
+    )
+    parser.add_argument(
+        "--hnsw-m",
+        type=int,
+        default=16,
+        help="The max number of connections per layer of the HNSW index",
+    )
+    parser.add_argument(
+        "--hnsw-ef-construction",
+        type=int,
+        default=64,
+        help="The size of the candidate list used when building the HNSW index",
+    )
+    parser.add_argument(
+        "--ivfflat-lists",
+        type=int,
+        default=None,
+        help="The number of IVFFlat lists, defaults to rows / 1000",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Only rebuild the ANN indexes, use after bulk loads",
+    )
     args = parser.parse_args()
 
     # Get the secret name
@@ -46,19 +86,47 @@ if __name__ == "__main__":
         "host": creds["host"],
         "port": 1053,
     }
-    conn = create_sqlalchemy_connection(**credentials)
-
-    # Load in the hubspot data and create some sqlite tables.
-    file_names = os.listdir(args.seed_data_path)
-    for file_name in file_names:
-        print(file_name)
-        if file_name != ".DS_Store":
-            table_name = file_name.split(".")[0].replace("-", "_")
-            df = pd.read_csv(
-                os.path.join(args.seed_data_path, file_name), encoding="utf-8"
-            )
-            conn = create_sqlalchemy_connection(**credentials)
-            df.to_sql(table_name, conn, if_exists="replace", index=False)
+    index_params = {
+        "method": args.index_type,
+        "m": args.hnsw_m,
+        "ef_construction": args.hnsw_ef_construction,
+        "lists": args.ivfflat_lists,
+    }
+
+    # Rebuild the ANN index and stop, nothing else needs to be touched.
+    if args.reindex:
+        if args.index_type == "none":
+            parser.error("--reindex needs an --index-type")
+        conn = create_connection(**credentials)
+        reindex_vector_index(conn, **index_params)
+        reindex_vector_index(conn, table="user_queries", **index_params)
+        conn.close()
+        exit(0)
+
+    # Track a version per data table, the API drops cached results for a table when
+    # its version changes. The seed loader bumps it every time it reloads a table.
+    conn = create_connection(**credentials)
+    cur = conn.cursor()
+    table_create_command = """
+    CREATE TABLE IF NOT EXISTS table_versions (
+                table_name text PRIMARY KEY,
+                version bigint NOT NULL DEFAULT 0,
+                updated_at timestamptz DEFAULT now()
+                );
+                """
+
+    cur.execute(table_create_command)
+    cur.close()
+    conn.commit()
+    conn.close()
+
+    # Load in the hubspot data and create a table for each csv.
+    load_seed_directory(
+        credentials,
+        args.seed_data_path,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
 
     # Enable the Vector extension for PGSQL
     conn = create_connection(**credentials)
@@ -67,19 +135,65 @@ if __name__ == "__main__":
     conn.commit()
     conn.close()
 
+    # Track a schema version which the API uses to know when to refresh its cached
+    # schema context. The event trigger bumps it after every DDL command.
+    conn = create_connection(**credentials)
+    cur = conn.cursor()
+    cur.execute(
+        """
+    CREATE TABLE IF NOT EXISTS schema_version (
+                id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                version bigint NOT NULL DEFAULT 0
+                );
+    INSERT INTO schema_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING;
+    CREATE OR REPLACE FUNCTION bump_schema_version() RETURNS event_trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        -- Don't block DDL (including dropping this table) if the table is missing.
+        IF to_regclass('public.schema_version') IS NOT NULL THEN
+            UPDATE public.schema_version SET version = version + 1 WHERE id = 1;
+        END IF;
+    END;
+    $$;
+    DROP EVENT TRIGGER IF EXISTS bump_schema_version;
+    CREATE EVENT TRIGGER bump_schema_version ON ddl_command_end
+        EXECUTE FUNCTION bump_schema_version();
+    """
+    )
+    cur.close()
+    conn.commit()
+    conn.close()
+
     # Create a database to hold user queries
     conn = create_connection(**credentials)
     cur = conn.cursor()
     table_create_command = """
-    CREATE TABLE user_queries (
+    CREATE TABLE IF NOT EXISTS user_queries (
                 id bigserial PRIMARY KEY, 
                 user_query text,
                 sql_query text,
-                conversation_history text
+                conversation_history text,
+                embedding vector(384),  -- the embedding of user_query
+                succeeded boolean DEFAULT false,
+                schema_version text,
+                guard_action text,  -- what the cost guard did with sql_query
+                created_at timestamptz DEFAULT now()
                 );
                 """
 
     cur.execute(table_create_command)
+    # Add the columns the API's answer cache and query logger use to tables created
+    # before them.
+    cur.execute(
+        """
+    ALTER TABLE user_queries
+        ADD COLUMN IF NOT EXISTS embedding vector(384),
+        ADD COLUMN IF NOT EXISTS succeeded boolean DEFAULT false,
+        ADD COLUMN IF NOT EXISTS schema_version text,
+        ADD COLUMN IF NOT EXISTS created_at timestamptz DEFAULT now(),
+        ADD COLUMN IF NOT EXISTS guard_action text;
+    """
+    )
     cur.close()
     conn.commit()
 
@@ -97,6 +211,44 @@ if __name__ == "__main__":
                 );
                 """
 
+    cur.execute(table_create_command)
+    # Template names become tool names so they have to be unique. The API relies on this
+    # index to reject names stored by a concurrent /add.
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS queries_name_key ON queries (name)")
+    cur.close()
+    conn.commit()
+
+    # Create the table the API uses as a shared, persistent embedding cache.
+    conn = create_connection(**credentials)
+    cur = conn.cursor()
+    table_create_command = """
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+                key text PRIMARY KEY,
+                model text,
+                embedding vector(384),
+                created_at timestamptz DEFAULT now()
+                );
+                """
+
+    cur.execute(table_create_command)
+    cur.close()
+    conn.commit()
+
+    # Create the table of table and column embeddings the API uses to only send the LLM
+    # the relevant part of the schema. The API fills it whenever the schema changes.
+    conn = create_connection(**credentials)
+    cur = conn.cursor()
+    table_create_command = """
+    CREATE TABLE IF NOT EXISTS schema_embeddings (
+                key text PRIMARY KEY,  -- schema.table or schema.table.column
+                table_schema text,
+                table_name text,
+                column_name text,  -- null for the table itself
+                description text,
+                embedding vector(384)
+                );
+                """
+
     cur.execute(table_create_command)
     cur.close()
     conn.commit()
@@ -171,15 +323,18 @@ if __name__ == "__main__":
             ),
         ]
 
-    for name, query, args, arg_types in QUERIES:
-        runtime = boto3.client("sagemaker-runtime")
-        input_data = {"text": query}
-        response = runtime.invoke_endpoint(
-            EndpointName="query-embedding",
-            ContentType="application/json",
-            Body=json.dumps(input_data),
-        )
-        embedding = json.loads(response["Body"].read().decode())
+    # Embed all of the queries in batches instead of one request per query.
+    embeddings = get_embeddings([query for _, query, _, _ in QUERIES])
+    conn = create_connection(**credentials)
+    for (name, query, query_args, arg_types), embedding in zip(QUERIES, embeddings):
+        add_query_to_db(conn, name, query, query_args, arg_types, embedding)
+    conn.close()
+
+    # Build the ANN index once the queries are loaded, building after the load is
+    # faster and IVFFlat needs the data to pick its lists. user_queries is indexed
+    # too so the API can find previously answered questions.
+    if args.index_type != "none":
         conn = create_connection(**credentials)
-        add_query_to_db(conn, name, query, args, arg_types, embedding)
+        create_vector_index(conn, **index_params)
+        create_vector_index(conn, table="user_queries", **index_params)
         conn.close()
@@ -1,19 +1,51 @@
 from sqlalchemy import create_engine
 import psycopg2
-from psycopg2 import OperationalError
+from psycopg2 import OperationalError, sql
 
 import boto3
 from botocore.exceptions import ClientError
-from typing import Optional
+from typing import Callable, Dict, Optional
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+import io
+import os
 import json
 import base64
+import time
 import numpy as np
+import pandas as pd
 import psycopg2
-from typing import List
+from typing import Any, List
 from psycopg2.extras import execute_values
 from pgvector.psycopg2 import register_vector
 
 
+def get_embeddings(
+    texts: List[str],
+    endpoint_name: str = "query-embedding",
+    chunk_size: int = 64,
+    runtime=None,
+) -> List[List[float]]:
+    """Embed a list of texts with the sagemaker endpoint, `chunk_size` texts per request.
+
+    :param texts: The texts to embed.
+    :param endpoint_name: The name of the sagemaker embedding endpoint.
+    :param chunk_size: The maximum number of texts sent in a single request.
+    :param runtime: An optional sagemaker-runtime client to reuse.
+    :return: One embedding per text in the same order as `texts`.
+    """
+    if runtime is None:
+        runtime = boto3.client("sagemaker-runtime")
+    embeddings = []
+    for i in range(0, len(texts), chunk_size):
+        response = runtime.invoke_endpoint(
+            EndpointName=endpoint_name,
+            ContentType="application/json",
+            Body=json.dumps({"texts": texts[i : i + chunk_size]}),
+        )
+        embeddings.extend(json.loads(response["Body"].read().decode()))
+    return embeddings
+
+
 def get_secret(
     secret_name: str,
     region_name: str = "us-west-2",
@@ -144,3 +176,328 @@ def add_query_to_db(
     )
     # Commit after we insert all embeddings
     conn.commit()
+
+
+def vector_index_name(table: str, column: str, method: str) -> str:
+    return f"{table}_{column}_{method}_idx"
+
+
+def create_vector_index(
+    conn,
+    method: str = "hnsw",
+    table: str = "queries",
+    column: str = "embedding",
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: Optional[int] = None,
+):
+    """Create an approximate nearest neighbor index for cosine distance on a vector column.
+
+    Any index of the other method on the same column is dropped so there is only ever
+    one ANN index to maintain.
+
+    :param conn: An open psycopg2 connection.
+    :param method: Either "hnsw" or "ivfflat".
+    :param table: The table holding the vectors.
+    :param column: The vector column to index.
+    :param m: The max number of connections per HNSW layer.
+    :param ef_construction: The size of the HNSW candidate list while building.
+    :param lists: The number of IVFFlat lists. Defaults to rows / 1000 (at least 10)
+        which is the pgvector recommendation for tables under a million rows.
+    """
+    if method not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Unknown vector index method {method}")
+    cur = conn.cursor()
+    for other in ("hnsw", "ivfflat"):
+        if other != method:
+            cur.execute(
+                f"DROP INDEX IF EXISTS {vector_index_name(table, column, other)}"
+            )
+    name = vector_index_name(table, column, method)
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    else:
+        if lists is None:
+            cur.execute(f"SELECT count(*) FROM {table}")
+            lists = max(cur.fetchone()[0] // 1000, 10)
+        options = f"lists = {int(lists)}"
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+        f"USING {method} ({column} vector_cosine_ops) WITH ({options})"
+    )
+    conn.commit()
+    print(f"Created {method} index {name} with ({options})")
+
+
+def reindex_vector_index(
+    conn,
+    method: str = "hnsw",
+    table: str = "queries",
+    column: str = "embedding",
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: Optional[int] = None,
+):
+    """Rebuild the ANN index on a vector column, run this after bulk loads.
+
+    HNSW indexes are rebuilt in place with REINDEX CONCURRENTLY so reads keep working.
+    IVFFlat indexes are dropped and recreated because their lists are computed from the
+    data present at build time.
+    """
+    name = vector_index_name(table, column, method)
+    if method == "ivfflat":
+        cur = conn.cursor()
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.commit()
+        create_vector_index(conn, method, table, column, m, ef_construction, lists)
+        return
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    if cur.fetchone()[0] is None:
+        conn.commit()
+        create_vector_index(conn, method, table, column, m, ef_construction, lists)
+        return
+    conn.commit()
+    # REINDEX CONCURRENTLY can't run inside a transaction block.
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(f"REINDEX INDEX CONCURRENTLY {name}")
+    finally:
+        conn.autocommit = autocommit
+    print(f"Rebuilt index {name}")
+
+
+# How pandas dtypes are stored in postgres, this mirrors what DataFrame.to_sql creates.
+PANDAS_TO_POSTGRES = {
+    "b": "boolean",
+    "i": "bigint",
+    "u": "bigint",
+    "f": "double precision",
+}
+
+
+def postgres_type(dtype) -> str:
+    """Map a pandas dtype to a postgres column type, anything unknown is stored as text."""
+    return PANDAS_TO_POSTGRES.get(dtype.kind, "text")
+
+
+def widen_postgres_type(current: str, new: str) -> str:
+    """Get a type that can hold values of both types, e.g. bigint and double precision."""
+    if current == new:
+        return current
+    if {current, new} == {"bigint", "double precision"}:
+        return "double precision"
+    return "text"
+
+
+def bump_table_version(conn, table_name: str):
+    """Record that a table's data changed so the API drops results cached from it.
+
+    Does nothing if the `table_versions` table hasn't been created. Doesn't commit so the
+    bump lands in the same transaction as the change.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.table_versions')")
+    if cur.fetchone()[0] is None:
+        return
+    cur.execute(
+        """
+        INSERT INTO table_versions (table_name, version) VALUES (%s, 1)
+        ON CONFLICT (table_name)
+        DO UPDATE SET version = table_versions.version + 1, updated_at = now()
+        """,
+        (table_name,),
+    )
+
+
+def copy_csv_to_table(
+    conn,
+    csv_path: str,
+    table_name: str,
+    chunk_size: int = 100_000,
+    encoding: str = "utf-8",
+    progress: Optional[Callable[[int], None]] = None,
+) -> Dict[str, float]:
+    """Load a CSV into a table with COPY FROM STDIN, one chunk at a time.
+
+    The file is parsed with pandas in chunks of `chunk_size` rows so memory stays flat.
+    The column types are inferred from the first chunk and widened if a later chunk
+    doesn't fit (e.g. a bigint column that turns out to hold floats). The rows are
+    loaded into a staging table which replaces `table_name` in a single transaction
+    once every row is in, so readers never see a partially loaded table.
+
+    DDL on the staging table is committed straight away. setup_db.py's
+    bump_schema_version trigger updates one row on every DDL command, holding its lock
+    until the commit would make parallel loads wait for each other.
+
+    :param conn: An open psycopg2 connection.
+    :param csv_path: The path to the CSV file.
+    :param table_name: The table to create or replace.
+    :param chunk_size: The number of rows parsed and copied at a time.
+    :param encoding: The encoding of the CSV file.
+    :param progress: Called with the number of rows loaded so far after every chunk.
+    :return: The number of rows, the elapsed seconds, and the rows per second.
+    """
+    start = time.perf_counter()
+    staging_name = f"{table_name}__staging"
+    table = sql.Identifier(table_name)
+    staging = sql.Identifier(staging_name)
+    cur = conn.cursor()
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(staging))
+    conn.commit()
+
+    column_types: Dict[str, str] = {}
+    rows = 0
+    try:
+        for chunk in pd.read_csv(csv_path, encoding=encoding, chunksize=chunk_size):
+            chunk_types = {c: postgres_type(t) for c, t in chunk.dtypes.items()}
+            if not column_types:
+                column_types = chunk_types
+                cur.execute(
+                    sql.SQL("CREATE TABLE {} ({})").format(
+                        staging,
+                        sql.SQL(", ").join(
+                            sql.SQL("{} {}").format(sql.Identifier(c), sql.SQL(t))
+                            for c, t in column_types.items()
+                        ),
+                    )
+                )
+                conn.commit()
+            for column, new_type in chunk_types.items():
+                widened = widen_postgres_type(column_types[column], new_type)
+                if widened != column_types[column]:
+                    cur.execute(
+                        sql.SQL(
+                            "ALTER TABLE {} ALTER COLUMN {} TYPE {} USING {}::{}"
+                        ).format(
+                            staging,
+                            sql.Identifier(column),
+                            sql.SQL(widened),
+                            sql.Identifier(column),
+                            sql.SQL(widened),
+                        )
+                    )
+                    # Also commits the chunks copied so far, staging isn't read by anyone.
+                    conn.commit()
+                    column_types[column] = widened
+
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cur.copy_expert(
+                sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                    staging,
+                    sql.SQL(", ").join(sql.Identifier(c) for c in chunk.columns),
+                ),
+                buffer,
+            )
+            rows += len(chunk)
+            if progress is not None:
+                progress(rows)
+        conn.commit()
+
+        # Swap the staging table in atomically.
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(staging, table))
+        bump_table_version(conn, table_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(staging))
+        conn.commit()
+        raise
+
+    seconds = time.perf_counter() - start
+    rows_per_second = rows / seconds if seconds > 0 else float(rows)
+    print(
+        f"Loaded {rows} rows into {table_name} in {seconds:.1f}s "
+        f"({rows_per_second:,.0f} rows/s)"
+    )
+    return {"rows": rows, "seconds": seconds, "rows_per_second": rows_per_second}
+
+
+def load_seed_file(
+    credentials: Dict[str, Any], csv_path: str, table_name: str, chunk_size: int
+) -> Dict[str, Any]:
+    """Load one seed CSV on its own connection. Runs inside a worker process."""
+    conn = create_connection(**credentials)
+    if conn is None:
+        raise RuntimeError(f"Couldn't connect to the database to load {csv_path}")
+    try:
+        stats = copy_csv_to_table(
+            conn,
+            csv_path,
+            table_name,
+            chunk_size=chunk_size,
+            progress=lambda rows: print(f"[{table_name}] {rows:,} rows"),
+        )
+    finally:
+        conn.close()
+    return {"table": table_name, **stats}
+
+
+def load_seed_directory(
+    credentials: Dict[str, Any],
+    seed_data_path: str,
+    workers: int = 1,
+    chunk_size: int = 100_000,
+) -> List[Dict[str, Any]]:
+    """Load every CSV in a folder into a table named after the file.
+
+    With more than one worker the files are loaded concurrently in a process pool so
+    parsing uses several cores. Each worker holds one database connection so at most
+    `workers` connections are open. The largest files start first so the total time
+    is close to the time of the largest file. The first failure cancels every file
+    that hasn't started and is re-raised.
+
+    :param credentials: The database credentials passed to `create_connection`.
+    :param seed_data_path: The folder of CSVs.
+    :param workers: The number of files to load at the same time.
+    :param chunk_size: The number of rows parsed and copied at a time.
+    :return: The stats for each loaded table.
+    """
+    files = [
+        (os.path.join(seed_data_path, f), f.split(".")[0].replace("-", "_"))
+        for f in os.listdir(seed_data_path)
+        if f != ".DS_Store"
+    ]
+    files.sort(key=lambda f: os.path.getsize(f[0]), reverse=True)
+
+    start = time.perf_counter()
+    results = []
+    if workers <= 1:
+        for csv_path, table_name in files:
+            results.append(
+                load_seed_file(credentials, csv_path, table_name, chunk_size)
+            )
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [
+            executor.submit(load_seed_file, credentials, path, table, chunk_size)
+            for path, table in files
+        ]
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    # Raises the worker's exception, failing fast.
+                    results.append(future.result())
+                    print(f"Finished {len(results)}/{len(files)} files")
+        finally:
+            executor.shutdown(wait=not pending, cancel_futures=True)
+
+    wall_seconds = time.perf_counter() - start
+    total_rows = sum(r["rows"] for r in results)
+    print(f"{'table':<40} {'rows':>12} {'seconds':>9} {'rows/s':>12}")
+    for r in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        print(
+            f"{r['table']:<40} {r['rows']:>12,} {r['seconds']:>9.1f} "
+            f"{r['rows_per_second']:>12,.0f}"
+        )
+    print(
+        f"Loaded {total_rows:,} rows from {len(results)} files in {wall_seconds:.1f}s "
+        f"with {workers} worker(s) ({total_rows / max(wall_seconds, 1e-9):,.0f} rows/s)"
+    )
+    return results